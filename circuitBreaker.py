@@ -0,0 +1,101 @@
+"""
+Circuit breaker so we stop hammering a server that is not working.
+
+closed:    Everything is sent, consecutive failures are counted and when they
+           reach the threshold the breaker opens.
+open:      Nothing is sent until the retry time, then one probe request is
+           allowed through and the breaker is half_open.
+half_open: The probe is running, if it works the breaker closes, if it fails
+           it opens again with twice the delay, up to max_delay.
+"""
+
+import time,threading
+
+class circuitBreaker():
+
+    CLOSED    = 0
+    OPEN      = 1
+    HALF_OPEN = 2
+    state_names = ('closed','open','half_open')
+
+    def __init__(self,logger,name,threshold=3,base_delay=15,max_delay=600,callback=None):
+        self.logger     = logger
+        self.name       = name
+        self.threshold  = threshold
+        self.base_delay = base_delay
+        self.max_delay  = max_delay
+        # Called with this breaker when the state or counters change.
+        self.callback   = callback
+        self.lock       = threading.Lock()
+        self.state      = self.CLOSED
+        self.delay      = base_delay
+        self.retry_at   = 0
+        self.failures   = 0
+        self.rejected   = 0
+        self.trips      = 0
+
+    def available(self):
+        """
+        True if a request would be allowed now, without using up the probe.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return time.time() >= self.retry_at
+            return False
+
+    def allow(self):
+        """
+        Call before sending a request, returns False if it should not be sent.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() >= self.retry_at:
+                self.logger.warning("{}: circuit half_open, sending probe".format(self.name))
+                self.state = self.HALF_OPEN
+                allowed = True
+            else:
+                self.rejected += 1
+                allowed = False
+        self._changed()
+        return allowed
+
+    def success(self):
+        with self.lock:
+            changed = self.state != self.CLOSED or self.failures > 0
+            if self.state != self.CLOSED:
+                self.logger.warning("{}: circuit closed after {} rejected requests".format(self.name,self.rejected))
+            self.state    = self.CLOSED
+            self.failures = 0
+            self.rejected = 0
+            self.delay    = self.base_delay
+        if changed:
+            self._changed()
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                # Probe failed, wait longer next time.
+                self.delay = min(self.delay * 2,self.max_delay)
+                self._open()
+            elif self.state == self.CLOSED and self.failures >= self.threshold:
+                self.delay = self.base_delay
+                self.trips += 1
+                self._open()
+        self._changed()
+
+    # Must be called with the lock held.
+    def _open(self):
+        self.state    = self.OPEN
+        self.retry_at = time.time() + self.delay
+        self.logger.error("{}: circuit open after {} failures, next try in {} seconds".format(self.name,self.failures,self.delay))
+
+    def _changed(self):
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception as e:
+                self.logger.error("{}: circuit callback failed: {}".format(self.name,e),exc_info=True)
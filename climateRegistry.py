@@ -0,0 +1,73 @@
+"""
+The climate types of one thermostat.
+
+The climates in climateList always have the same index, since ISY programs
+use them, and any other climates in the thermostat program get an index
+after those.  The extra refs are saved and passed back in, so a climate
+keeps its index even if others are added or removed.
+
+Lookups by ref or index are dict lookups, so they are cheap on every update.
+"""
+
+from node_funcs import climateList,climateMap
+
+class climateRegistry():
+
+    def __init__(self,climates=(),extra=()):
+        """
+        climates is the program climates, or the saved list of
+        {'name','ref'}, and extra is the list of refs not in climateList
+        that already have an index.
+        """
+        self.refs  = list(climateList) + [ref for ref in extra if not ref in climateMap]
+        self.index = { ref: i for i, ref in enumerate(self.refs) }
+        # ref to the program climate and name
+        self.climates = dict()
+        self.custom   = dict()
+        for climate in climates:
+            ref = climate['climateRef'] if 'climateRef' in climate else climate['ref']
+            self.climates[ref] = climate
+            self.custom[ref]   = climate['name']
+            if not ref in self.index:
+                self.index[ref] = len(self.refs)
+                self.refs.append(ref)
+
+    @property
+    def extra(self):
+        """
+        The refs not in climateList, in index order.
+        """
+        return self.refs[len(climateList):]
+
+    def index_of(self,ref):
+        """
+        Index of the climate ref, or None if it's not one we know.
+        """
+        return self.index.get(ref)
+
+    def ref(self,index):
+        """
+        The climate ref for index, or None if there isn't one.
+        """
+        index = int(index)
+        return self.refs[index] if 0 <= index < len(self.refs) else None
+
+    def climate(self,ref):
+        """
+        The program climate for ref, or None if it's not in the program.
+        """
+        return self.climates.get(ref)
+
+    def name(self,ref):
+        """
+        The name shown for ref, the thermostat's name for it if it has one.
+        """
+        if ref in self.custom:
+            return self.custom[ref]
+        return ref[0].upper() + ref[1:]
+
+    def names(self):
+        """
+        The names for all the indexes, in order.
+        """
+        return [self.name(ref) for ref in self.refs]
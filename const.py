@@ -71,7 +71,8 @@ driversMap = {
     { 'driver': 'GV8', 'value': 0, 'uom': '2' },
     { 'driver': 'GV9', 'value': 1, 'uom': '25' },
     { 'driver': 'GV10', 'value': 10, 'uom': '56' },
-    { 'driver': 'GV11', 'value': 10, 'uom': '56' }
+    { 'driver': 'GV11', 'value': 10, 'uom': '56' },
+    { 'driver': 'GV12', 'value': 0, 'uom': '58' }
   ],
   'EcobeeC': [
     { 'driver': 'ST', 'value': 0, 'uom': '4' },
@@ -92,7 +93,8 @@ driversMap = {
     { 'driver': 'GV8', 'value': 0, 'uom': '2' },
     { 'driver': 'GV9', 'value': 1, 'uom': '25' },
     { 'driver': 'GV10', 'value': 10, 'uom': '56' },
-    { 'driver': 'GV11', 'value': 10, 'uom': '56' }
+    { 'driver': 'GV11', 'value': 10, 'uom': '56' },
+    { 'driver': 'GV12', 'value': 0, 'uom': '58' }
   ],
   'EcobeeSensorF': [
     { 'driver': 'ST', 'value': 0, 'uom': '17' },
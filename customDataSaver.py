@@ -0,0 +1,146 @@
+"""
+Save customData to Polyglot and wait for it to be acknowledged.
+
+Polyglot doesn't answer a save directly, the new customData comes back in
+the next config.  Each save is tagged with the time it was sent, and
+config() is called from the config callback to wake up anyone waiting on
+that tag instead of polling for it.
+
+Only one save is sent at a time.  Saves that are requested while one is
+waiting replace each other, since each one is the whole customData, and the
+latest is sent next so a burst of saves is only two writes.
+"""
+
+import time,threading
+from datetime import datetime
+from collections import deque
+
+class customDataSaver():
+
+    # Format of the tag, also used for the lock in customData
+    tag_fmt = '%Y-%m-%dT%H:%M:%S.%f'
+
+    def __init__(self,logger,save,current,tag='_data_dtm'):
+        self.logger  = logger
+        # save(data) sends the customData to Polyglot.
+        self.save_func = save
+        # current() returns the customData Polyglot last sent us.
+        self.current = current
+        self.tag     = tag
+        self.cond    = threading.Condition()
+        # Data waiting to be sent, and the number of the save it will be
+        self.pending = None
+        self.pending_seq = 0
+        # Number of the last save sent and what happened to it
+        self.done_seq = 0
+        self.results = dict()
+        self.sending = False
+        # The tag Polyglot last sent back, and the last one we sent
+        self.acked   = None
+        self.sent    = None
+        # Seconds each save took to be acknowledged
+        self.latency = deque(maxlen=100)
+        self.stats   = { 'requests': 0, 'writes': 0, 'coalesced': 0, 'timeouts': 0 }
+
+    def config(self,customData):
+        """
+        Call with the customData from every config Polyglot sends.
+        """
+        with self.cond:
+            self.acked = customData.get(self.tag)
+            self.cond.notify_all()
+
+    def stale(self,customData):
+        """
+        True if customData is from before the last save we sent, so it
+        doesn't have the changes in that save yet.  The tags are times, so
+        they sort as strings.
+        """
+        with self.cond:
+            if self.sent is None:
+                return False
+            tag = customData.get(self.tag)
+            return tag is None or tag < self.sent
+
+    def save(self,data,timeout=10,tries=3):
+        """
+        Save data, and return the tag it was saved with once Polyglot has it,
+        or False if it didn't happen after tries attempts of timeout seconds.
+        """
+        with self.cond:
+            self.stats['requests'] += 1
+            if self.pending is None:
+                self.pending = dict(data)
+                self.pending_seq += 1
+            else:
+                # Each save is the whole customData, so the latest one replaces it.
+                self.stats['coalesced'] += 1
+                self.pending = dict(data)
+            seq = self.pending_seq
+            # Someone else is sending, wait for them to send ours too.
+            while self.sending and self.done_seq < seq:
+                self.cond.wait()
+            if self.done_seq >= seq:
+                return self.results.get(seq,False)
+            self.sending = True
+        # We send everything pending until ours is done.
+        try:
+            while True:
+                with self.cond:
+                    if self.pending is None:
+                        break
+                    ndata = self.pending
+                    nseq  = self.pending_seq
+                    self.pending = None
+                result = self._send(ndata,timeout,tries)
+                with self.cond:
+                    self.done_seq = nseq
+                    self.results[nseq] = result
+                    # Only keep the recent ones for waiters that haven't woken up yet.
+                    for old in [s for s in self.results if s < nseq - 10]:
+                        del self.results[old]
+                    self.cond.notify_all()
+                if nseq >= seq:
+                    break
+        finally:
+            with self.cond:
+                self.sending = False
+                self.cond.notify_all()
+        return self.results.get(seq,False)
+
+    def _send(self,ndata,timeout,tries):
+        for tcnt in range(1,tries+1):
+            dtns = datetime.now().strftime(self.tag_fmt)
+            ndata[self.tag] = dtns
+            with self.cond:
+                self.sent = dtns
+            start = time.time()
+            self.logger.info("customDataSaver: Sending try={} {}={}".format(tcnt,self.tag,dtns))
+            self.stats['writes'] += 1
+            self.save_func(ndata)
+            end = start + timeout
+            with self.cond:
+                while self.acked != dtns:
+                    # In case the config callback is missed, check what we have every second.
+                    if self.current().get(self.tag) == dtns:
+                        self.acked = dtns
+                        break
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(min(1,remaining))
+                if self.acked == dtns:
+                    self.latency.append(time.time() - start)
+                    self.logger.debug("customDataSaver: %s=%s saved in %.3f seconds",self.tag,dtns,time.time() - start)
+                    return dtns
+            self.stats['timeouts'] += 1
+            self.logger.error("customDataSaver: timeout waiting for custom data save to happen {}={} expecting {}".format(self.tag,self.current().get(self.tag),dtns))
+        # It never got there, so what Polyglot sends isn't older than it.
+        with self.cond:
+            if self.sent == dtns:
+                self.sent = self.acked
+        return False
+
+    def average_latency(self):
+        with self.cond:
+            return sum(self.latency) / len(self.latency) if len(self.latency) > 0 else 0
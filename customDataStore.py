@@ -0,0 +1,77 @@
+"""
+Copy on write store for customData.
+
+view() returns the current customData as a read only mapping, it's never
+changed so it can be used without copying it.  Changes are applied as a delta
+of top level keys to set and delete, and a new version is only made when
+a value is actually different.  The values are shared between versions, so
+they must be replaced, not changed in place.
+
+config() is called with what Polyglot sends back so the store follows any
+changes made elsewhere.  If a save fails, rollback() puts back the version
+from before it, so the store still matches what Polyglot has.
+"""
+
+import threading
+from types import MappingProxyType
+
+class customDataStore():
+
+    def __init__(self,logger,data=None):
+        self.logger  = logger
+        self.lock    = threading.Lock()
+        self.data    = MappingProxyType(dict(data) if data is not None else dict())
+        self.version = 0
+
+    def view(self):
+        return self.data
+
+    def get(self,key,default=None):
+        return self.data.get(key,default)
+
+    def config(self,customData):
+        """
+        Use the customData Polyglot sent.
+        """
+        with self.lock:
+            if customData != self.data:
+                self.data = MappingProxyType(dict(customData))
+                self.version += 1
+
+    def apply(self,changes=None,delete=()):
+        """
+        Set the keys in changes and remove the keys in delete.  Returns the
+        new customData as a dict to send to Polyglot, or None if nothing
+        was different.
+        """
+        with self.lock:
+            cur = self.data
+            changed = dict()
+            if changes is not None:
+                changed = { key: val for key, val in changes.items() if not key in cur or cur[key] != val }
+            deleted = [key for key in delete if key in cur]
+            if len(changed) == 0 and len(deleted) == 0:
+                return None
+            self.logger.debug("customDataStore: version %d set %s delete %s",self.version + 1,list(changed),deleted)
+            new = dict(cur)
+            new.update(changed)
+            for key in deleted:
+                del new[key]
+            self.data = MappingProxyType(new)
+            self.version += 1
+            return dict(new)
+
+    def rollback(self,prev,data):
+        """
+        Put back prev, the view() from before the apply that returned data,
+        when saving data failed.  Nothing is done if something else changed
+        the store since then.
+        """
+        with self.lock:
+            if dict(self.data) != data:
+                self.logger.debug("customDataStore: version %d changed since the failed save, not rolling back",self.version)
+                return False
+            self.logger.debug("customDataStore: rolling back version %d",self.version)
+            self.data = prev
+            self.version += 1
+            return True
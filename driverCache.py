@@ -0,0 +1,45 @@
+"""
+Mixin for Nodes so only driver values that changed are sent to Polyglot.
+
+The last value and uom reported for each driver is kept, and set_driver
+skips the setDriver when they are the same.  reportDrivers/query still
+send everything.
+"""
+
+class driverCache():
+
+    # Totals for all nodes
+    totals = { 'emitted': 0, 'suppressed': 0 }
+
+    def set_driver(self,driver,value,uom=None,force=False):
+        """
+        Send the driver value if it's different from what we last sent.
+        Returns True if it was sent.
+        """
+        cache = self.__dict__.setdefault('_driver_cache',dict())
+        stats = self.__dict__.setdefault('driver_stats',{ 'emitted': 0, 'suppressed': 0 })
+        cuom = self._driver_uom(driver) if uom is None else uom
+        # Compare what's actually sent, polyinterface sends str(value), so '1' and 1 are the same.
+        key = (str(value),str(cuom))
+        if not force and cache.get(driver) == key:
+            stats['suppressed'] += 1
+            driverCache.totals['suppressed'] += 1
+            return False
+        cache[driver] = key
+        stats['emitted'] += 1
+        driverCache.totals['emitted'] += 1
+        if uom is None:
+            self.setDriver(driver,value)
+        else:
+            self.setDriver(driver,value,uom=uom)
+        return True
+
+    def _driver_uom(self,driver):
+        # Polyglot cloud converts the drivers list to a dict.
+        if isinstance(self.drivers,dict):
+            d = self.drivers.get(driver)
+            return d.get('uom') if isinstance(d,dict) else None
+        for d in self.drivers:
+            if d['driver'] == driver:
+                return d['uom']
+        return None
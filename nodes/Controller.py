@@ -22,13 +22,24 @@ import os
 import os.path
 import re
 import logging
-from copy import deepcopy
+import threading
+import concurrent.futures
 
 from pgSession import pgSession
+from pgLog import getLogger,set_levels,lazyJson
+from revTracker import revTracker,revisionRecord
+from circuitBreaker import circuitBreaker
+from pollScheduler import pollScheduler
+from tokenManager import tokenManager
+from customDataSaver import customDataSaver
+from customDataStore import customDataStore
+from profileBuilder import profileBuilder
+from climateRegistry import climateRegistry
+from driverCache import driverCache
 from nodes import Thermostat
 from node_funcs import *
 
-LOGGER = polyinterface.LOGGER
+LOGGER = getLogger(polyinterface.LOGGER,'Controller')
 
 ECOBEE_API_URL = 'api.ecobee.com'
 
@@ -36,17 +47,34 @@ class Controller(Controller):
     def __init__(self, polyglot):
         super().__init__(polyglot)
         self.name = 'Ecobee Controller'
-        self.tokenData = {}
+        # All access to the tokens goes through this, see tokenData
+        self.tokens = tokenManager(LOGGER,self._getRefresh,self._saveTokens)
+        # Saves customData and waits for Polyglot to send it back
+        self.saver = customDataSaver(LOGGER,self.saveCustomData,lambda: self.polyConfig['customData'],tag=self._data_tag)
+        # Read only view of customData that is changed with updateCustomData
+        self.store = customDataStore(LOGGER)
+        # Builds the custom profile, see check_profile
+        self.profile = None
+        # The shared nodedef id for each thermostat, see profileId
+        self.profile_ids = dict()
         self.msgi = {}
         self.in_discover = False
         self.discover_st = False
-        self.refreshingTokens = False
         self.pinRun = False
         self._last_dtns = False
+        # A customData save failed and auth was set False because of it
+        self._save_failed = False
         self.hb = 0
         self.ready = False
         self.waiting_on_tokens = False
         self._cloud = CLOUD
+        self.revs = revTracker(LOGGER)
+        # Thermostats waiting for a fetch after a write, see reconcile
+        self.reconcile_lock  = threading.Lock()
+        self.reconcile_ids   = set()
+        self.reconcile_timer = None
+        # Only one poll of the thermostats at a time
+        self.poll_lock = threading.Lock()
 
     def start(self):
         LOGGER.info('Started Ecobee v2 NodeServer')
@@ -55,30 +83,29 @@ class Controller(Controller):
         self.serverdata = get_server_data(LOGGER)
         LOGGER.info('Ecobee NodeServer Version {}'.format(self.serverdata['version']))
         nsv = 'nodeserver_version'
-        ud  = False
-        cust_data = self.polyConfig['customData']
+        self.store.config(self.polyConfig['customData'])
+        cust_data = self.store.view()
         if not nsv in cust_data:
             LOGGER.info("Adding {}={} to customData".format(nsv,self.serverdata['version']))
-            cust_data[nsv] = self.serverdata['version']
-            ud = True
         elif cust_data[nsv] != self.serverdata['version']:
             LOGGER.info("Update {} from {} to {} in customData".format(nsv,cust_data[nsv],self.serverdata['version']))
-            cust_data[nsv] = self.serverdata['version']
-            ud = True
         # Delete the saved token data we were doing for a while
         # For PG3 we can start doing it again, but not in PG2 since it costs $$
-        # Can't iterate over keys, since the keys get removed, causes python crash
-        keys = list(cust_data.keys())
-        for key in keys:
+        delete = list()
+        for key in cust_data:
             if re.match('tokenData2020.*',key):
                 LOGGER.info("Deleting old customData key {}".format(key))
-                del cust_data[key]
-        if ud:
-            self.saveCustomDataWait(cust_data)
+                delete.append(key)
+        # Only saved if something changed.
+        self.updateCustomData({nsv: self.serverdata['version']},delete,lock=None)
+        cust_data = self.store.view()
         #LOGGER.debug("init=\n"+json.dumps(self.poly.init,sort_keys=True,indent=2))
-        LOGGER.debug("customData=\n"+json.dumps(cust_data,sort_keys=True,indent=2))
+        LOGGER.debug("customData=\n%s",lazyJson(cust_data))
         self.set_debug_mode()
-        self.get_session() 
+        self.get_params()
+        self.get_session()
+        # We allow for 10 long polls to refresh the token, also for tokens from a new authorization.
+        self.tokens.lead = int(self.polyConfig['longPoll']) * 10
         # Anything special to do in pgtest development mode?
         #if self.poly.init['development']:
         #
@@ -106,7 +133,7 @@ class Controller(Controller):
         # Make sure they are using the latest API
         if self.check_api():
             if 'tokenData' in self.polyConfig['customData']:
-                self.tokenData = self.polyConfig['customData']['tokenData']
+                self.tokens.set(self.polyConfig['customData']['tokenData'])
                 if self._checkTokens():
                     LOGGER.info("start: Calling discover...")
                     self.discover()
@@ -128,6 +155,9 @@ class Controller(Controller):
             LOGGER.debug("{}:shortPoll: Skipping since discover is still running".format(self.address))
             return
         if self.waiting_on_tokens is False:
+            # Check any thermostats that are due
+            if self.discover_st is True:
+                self.pollThermostats(int(self.polyConfig['shortPoll']))
             return
         elif self.waiting_on_tokens == "OAuth":
             LOGGER.debug("{}:shortPoll: Waiting for user to authorize...".format(self.address))
@@ -153,10 +183,34 @@ class Controller(Controller):
         if self.in_discover:
             LOGGER.debug("{}:longPoll: Skipping since discover is still running".format(self.address))
             return
+        if not self.breaker.available():
+            LOGGER.warning("{}:longPoll: Skipping since Ecobee circuit is open".format(self.address))
+            return
         if self.discover_st is False:
-            LOGGER.info("longPoll: Calling discover...")
-            self.discover()
-        self.updateThermostats()
+            # Everything this poll does must be done before the next one starts.
+            with self.session.deadline(time.time() + int(self.polyConfig['longPoll'])):
+                LOGGER.info("longPoll: Calling discover...")
+                self.discover()
+        self.pollThermostats(int(self.polyConfig['longPoll']))
+        LOGGER.debug("%s:longPoll: drivers %s requests in the last hour %s",self.address,driverCache.totals,self.poller.used())
+
+    def pollThermostats(self,limit,force=False):
+        """
+        Update the thermostats the poll scheduler says are due, or all of
+        them when force is True, this must finish within limit seconds.
+        """
+        if not self.breaker.available():
+            LOGGER.debug("%s:pollThermostats: Skipping since Ecobee circuit is open",self.address)
+            return
+        # shortPoll and longPoll may both be due, a forced poll waits for the running one.
+        if not self.poll_lock.acquire(blocking=force):
+            LOGGER.debug("%s:pollThermostats: Skipping since a poll is already running",self.address)
+            return
+        try:
+            with self.session.deadline(time.time() + limit):
+                self.updateThermostats(force=force)
+        finally:
+            self.poll_lock.release()
 
     def heartbeat(self):
         LOGGER.debug('heartbeat hb={}'.format(self.hb))
@@ -178,8 +232,55 @@ class Controller(Controller):
         #if self.ecobeeDelete():
         #    self.tokenData = {}
 
+    # Custom parameters and their defaults
+    _params = {
+        # Maximum number of Ecobee requests to run at the same time
+        'fetch_workers': 4,
+        # Seconds to wait for thermostat data before giving up on it
+        'fetch_timeout': 120,
+        # Number of thermostats to get in each request, Ecobee allows 25
+        'fetch_batch': 25,
+        # Seconds one request to Ecobee may take, including retries
+        'request_budget': 120,
+        # Milliseconds to collect thermostat commands before sending them together
+        'write_window': 500,
+        # Seconds after a write to get the thermostat state, 0 to wait for the next poll
+        'reconcile_delay': 10,
+        # Seconds between checks of a thermostat that is active, idle and the most for one that's not doing anything
+        'poll_min': 60,
+        'poll_idle': 180,
+        'poll_max': 900,
+        # Maximum number of requests to Ecobee an hour for polling
+        'poll_budget': 300,
+    }
+
+    def get_params(self):
+        params = self.polyConfig.get('customParams',{})
+        add = dict()
+        for name, default in self._params.items():
+            val = default
+            if name in params:
+                try:
+                    val = int(params[name])
+                except ValueError:
+                    LOGGER.error("get_params: {}={} is not an integer, using {}".format(name,params[name],default))
+            else:
+                add[name] = default
+            setattr(self,name,val)
+            LOGGER.info("get_params: {}={}".format(name,val))
+        # Add the defaults so users can see them.
+        if len(add) > 0:
+            self.addCustomParam(add)
+        self.fetch_batch = min(max(1,self.fetch_batch),self._batch_size)
+        self.poller = pollScheduler(LOGGER,self.poll_min,self.poll_idle,self.poll_max,self.poll_budget)
+
     def get_session(self):
-        self.session = pgSession(self,self.name,LOGGER,ECOBEE_API_URL,debug_level=self.debug_level)
+        # All requests go through the breaker so we stop trying when Ecobee is down.
+        self.breaker = circuitBreaker(LOGGER,'Ecobee API',callback=self.set_breaker_st)
+        # Leave room for commands to run while all the fetch workers are busy.
+        self.session = pgSession(self,self.name,getLogger(polyinterface.LOGGER,'pgSession'),ECOBEE_API_URL,debug_level=self.debug_level,
+                                 pool_size=self.fetch_workers+2,max_workers=self.fetch_workers,
+                                 budget=self.request_budget,breaker=self.breaker)
 
     def check_api(self):
         """
@@ -209,10 +310,11 @@ class Controller(Controller):
         # Need to re-auth!
         LOGGER.error('_reAuth because: {}'.format(reason))
         self.addNotice({'reauth': "Must Re-Authorize because {}".format(reason)})
-        cdata = deepcopy(self.polyConfig['customData'])
+        cdata = self.store.view()
         if not 'tokenData' in cdata:
             LOGGER.error('No tokenData in customData: {}'.format(cdata))
-        self.saveCustomDataWait(cdata)
+        # Clears the lock
+        self.updateCustomData()
         self.authorize()
 
     def _getPin(self):
@@ -224,7 +326,6 @@ class Controller(Controller):
                                   'scope':          'smartWrite'
                               })
         if res is False:
-            self.refreshingTokens = False
             return False
         res_data = res['data']
         res_code = res['code']
@@ -283,7 +384,7 @@ class Controller(Controller):
         if 'code' in oauth:
             if self._getTokens(oauth):
                 self.removeNoticesAll()
-                self.polyConfig['customData']['api_key'] = self.api_key
+                self.updateCustomData({'api_key': self.api_key},lock=None)
                 self.discover()
 
     def _expire_delta(self):
@@ -292,18 +393,22 @@ class Controller(Controller):
         ts_exp = datetime.strptime(self.tokenData['expires'], '%Y-%m-%dT%H:%M:%S')
         return ts_exp - datetime.now()
 
+    @property
+    def tokenData(self):
+        """
+        Read only snapshot of the current tokens, waits if they are being refreshed.
+        """
+        return self.tokens.get()
+
     def _checkTokens(self):
-        if self.refreshingTokens:
-            LOGGER.error('Waiting for token refresh to complete...')
-            while self.refreshingTokens:
-                time.sleep(.1)
-        if 'access_token' in self.tokenData:
+        tokenData = self.tokenData
+        if 'access_token' in tokenData:
             exp_d = self._expire_delta()
             if exp_d is not False:
-                # We allow for 10 long polls to refresh the token...
-                if exp_d.total_seconds() < int(self.polyConfig['longPoll']) * 10:
-                    self.l_info('_checkTokens','Tokens {} expires {} will expire in {} seconds, so refreshing now...'.format(self.tokenData['refresh_token'],self.tokenData['expires'],exp_d.total_seconds()))
-                    return self._getRefresh()
+                # The refresh timer should have got them already, unless it failed.
+                if exp_d.total_seconds() < self.tokens.lead:
+                    self.l_info('_checkTokens','Tokens {} expires {} will expire in {} seconds, so refreshing now...'.format(tokenData['refresh_token'],tokenData['expires'],exp_d.total_seconds()))
+                    return self.tokens.refresh(stale=tokenData)
                 else:
                     # Only print this ones, then once a minute at most...
                     sd = True
@@ -312,7 +417,7 @@ class Controller(Controller):
                         if md.total_seconds() < 60:
                             sd = False
                     if sd:
-                        self.l_debug('_checkTokens',0,'Tokens valid until: {} ({} seconds, longPoll={})'.format(self.tokenData['expires'],exp_d.seconds,int(self.polyConfig['longPoll'])))
+                        self.l_debug('_checkTokens',0,'Tokens valid until: {} ({} seconds, longPoll={})',self.tokenData['expires'],exp_d.seconds,int(self.polyConfig['longPoll']))
                     self.msgi['ctdt'] = datetime.now()
                     self.set_auth_st(True)
                     return True
@@ -347,38 +452,45 @@ class Controller(Controller):
                                 LOGGER.error(" Mine:    {}".format(self.tokenData))
                                 LOGGER.error(" Current: {}".format(self.polyConfig['customData']['tokenData']))
                                 LOGGER.error("We will use the new tokens...")
-                                self.tokenData = deepcopy(self.polyConfig['customData']['tokenData'])
+                                self.tokens.set(self.polyConfig['customData']['tokenData'])
                                 return False
                         except:
                             LOGGER.error("Failed determing age of last db write by someone else, will ignore it.",exc_info=True)
-        rval = self.lockCustomData()
-        if (rval):
-            self.refreshingTokens = True
-        return rval
+        return self.lockCustomData()
 
     # This is only called when refresh fails, when it works saveTokens clears
     # it, otherwise we get_ a race on who's customData is saved...
     def _endRefresh(self,refresh_data=False,test=False):
-        cdata = deepcopy(self.polyConfig['customData'])
         if refresh_data is not False:
             if 'expires_in' in refresh_data:
                 ts = time.time() + refresh_data['expires_in']
-                refresh_data['expires'] = datetime.fromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%S")
-            # Save new token data in customData
-            cdata['tokenData'] = refresh_data
-            # And save in our variable for checking, unless in test mode...
-            if not test:
-                self.tokenData = deepcopy(refresh_data)
+                refresh_data['expires'] = datetime.fromtimestamp(ts).strftime(self.tokens.expires_fmt)
+            # Save new token data in customData, and use them unless in test mode...
+            if test:
+                self._saveTokens(refresh_data)
+            else:
+                self.tokens.set(refresh_data,save=True)
             self.set_auth_st(True)
             self.removeNoticesAll()
-        self.saveCustomDataWait(cdata)
+        else:
+            self.updateCustomData()
         LOGGER.info('cleared lock')
-        self.refreshingTokens = False
+
+    # Saving customData also clears the lock.
+    def _saveTokens(self,tokenData):
+        self.updateCustomData({'tokenData': dict(tokenData)})
 
     # test option is passed in to force a refresh and save to db, but not our
     # locally saved self.tokenData.  This makes it look like someone else
     # refreshed the token, so we just grab from the db.
     def _getRefresh(self,test=False):
+        """
+        Get new tokens, only call this through self.tokens.refresh so only
+        one runs at a time.
+        """
+        if not self.breaker.available():
+            LOGGER.warning('_getRefresh: Not refreshing tokens since Ecobee circuit is open')
+            return False
         if 'refresh_token' in self.tokenData:
             if not self._startRefresh(test=test):
                 return False
@@ -479,44 +591,191 @@ class Controller(Controller):
             LOGGER.debug('Got tokens sucessfully.')
             self.removeNoticesAll()
             self.addNotice({'getTokens': 'Tokens obtained!'})
-            self.polyConfig['customData']['api_key'] = self.api_key
-            self.polyConfig['customData']['api_code'] = pinData['code']
+            # Saved with the tokens
+            self.store.apply({'api_key': self.api_key, 'api_code': pinData['code']})
             self._endRefresh(res_data)
             return True
         self.set_auth_st(False)
 
     def updateThermostats(self,force=False):
+        """
+        Check the thermostats that the poll scheduler says are due, or all of
+        them when force is True, and get the data for the ones that changed.
+        """
         LOGGER.debug("{}:updateThermostats: start".format(self.address))
+        if not force:
+            known = [node.thermostatId for node in list(self.nodes.values()) if isinstance(node,Thermostat)]
+            due = self.poller.due(known)
+            # New thermostats are found by discover, so nothing to do when none are due.
+            if len(known) > 0 and len(due) == 0:
+                LOGGER.debug("%s:updateThermostats: no thermostats due",self.address)
+                return
+            if not self.poller.allow():
+                return
         thermostats = self.getThermostats()
+        self.poller.spend()
         if not isinstance(thermostats, dict):
             LOGGER.error('Thermostats instance wasn\'t dictionary. Skipping...')
             return
+        if force or len(known) == 0:
+            due = list(thermostats)
+        # Collect all the thermostats that changed so they can be fetched together.
+        changed = dict()
         for thermostatId, thermostat in thermostats.items():
-            LOGGER.debug("{}:updateThermostats: {}".format(self.address,thermostatId))
-            if self.checkRev(thermostat):
-                address = self.thermostatIdToAddress(thermostatId)
-                if address in self.nodes:
-                    LOGGER.debug('Update detected in thermostat {}({}) doing full update.'.format(thermostat['name'], address))
-                    fullData = self.getThermostatFull(thermostatId)
-                    if fullData is not False:
-                        self.nodes[address].update(thermostat, fullData)
-                    else:
-                        LOGGER.error('Failed to get updated data for thermostat: {}({})'.format(thermostat['name'], thermostatId))
-                else:
-                    LOGGER.error("Thermostat id '{}' address '{}' is not in our node list. thermostat: {}".format(thermostatId,address,thermostat))
+            if not thermostatId in due:
+                continue
+            LOGGER.debug("%s:updateThermostats: %s",self.address,thermostatId)
+            address = self.thermostatIdToAddress(thermostatId)
+            # Nodes are only created by discover, which gets all their data.
+            if not address in self.nodes:
+                LOGGER.debug("%s:updateThermostats: %s has no node yet, left for discover",self.address,thermostatId)
+                continue
+            revs = self.changedRevs(thermostat)
+            # Nothing we show comes from these, so they are applied without a fetch.
+            unused = [rev for rev in revs if rev in self._unused_revs]
+            if len(unused) > 0:
+                self.revs.applied(thermostat,unused)
+                revs = [rev for rev in revs if not rev in self._unused_revs]
+            if len(revs) > 0:
+                LOGGER.debug('Update detected in thermostat %s(%s) for %s.',thermostat['name'], address, revs)
+                changed[thermostatId] = revs
             else:
                 LOGGER.info("No {} '{}' update detected".format(thermostatId,thermostat['name']))
+        # Group the changed thermostats by the sections they need, so each
+        # group is fetched together with only what changed.
+        groups = dict()
+        for thermostatId, revs in changed.items():
+            includes = self.getSelectionIncludes(revs,self.nodes[self.thermostatIdToAddress(thermostatId)])
+            key = tuple(sorted(includes.items()))
+            if not key in groups:
+                groups[key] = list()
+            groups[key].append(thermostatId)
+        # Thermostats with a new program, which may have new climate names.
+        programs = list()
+        def apply(thermostatId,data):
+            thermostat = thermostats[thermostatId]
+            if self.nodes[self.thermostatIdToAddress(thermostatId)].update(thermostat, data):
+                # Only remember the revisions once they are applied.
+                self.revs.applied(thermostat,changed[thermostatId])
+                if 'thermostatRev' in changed[thermostatId]:
+                    programs.append(thermostatId)
+        jobs = list()
+        for key, ids in groups.items():
+            LOGGER.debug("%s:updateThermostats: getting %s for %s",self.address,key,ids)
+            jobs.append((ids,dict(key)))
+        if len(jobs) > 0:
+            requests = sum([(len(ids) + self.fetch_batch - 1) // self.fetch_batch for ids, includes in jobs])
+            if force or self.poller.allow(requests):
+                self.poller.spend(requests)
+                for thermostatId in self.fetchSelections(jobs,apply):
+                    LOGGER.error('Failed to get updated data for thermostat: {}({})'.format(thermostats[thermostatId]['name'], thermostatId))
+            else:
+                # The revisions were not applied, so they will be fetched next time.
+                LOGGER.warning("{}:updateThermostats: Not getting data for {} to stay within poll_budget".format(self.address,list(changed)))
+        if len(programs) > 0:
+            LOGGER.info("{}:updateThermostats: Checking profile for new programs in {}".format(self.address,programs))
+            self.check_profile(thermostats,dict())
+        # Schedule the next check of each thermostat from what it's doing now.
+        for thermostatId in due:
+            node = self.nodes.get(self.thermostatIdToAddress(thermostatId))
+            if node is None or not thermostatId in thermostats:
+                continue
+            interval = self.poller.checked(thermostatId,thermostatId in changed,
+                                           connected=thermostats[thermostatId].connected == 'true',
+                                           running=node.equipmentRunning(),
+                                           hold_remaining=node.holdRemaining())
+            node.setPollInterval(interval)
         LOGGER.debug("{}:updateThermostats: done".format(self.address))
 
-    def checkRev(self, tstat):
-        if tstat['thermostatId'] in self.revData:
-            curData = self.revData[tstat['thermostatId']]
-            if (tstat['thermostatRev'] != curData['thermostatRev']
-                    or tstat['alertsRev'] != curData['alertsRev']
-                    or tstat['runtimeRev'] != curData['runtimeRev']
-                    or tstat['intervalRev'] != curData['intervalRev']):
-                return True
-        return False
+    def reconcile(self,thermostatId):
+        """
+        Schedule a fetch of the runtime, events and settings for thermostatId
+        reconcile_delay seconds from now, so the drivers show what the
+        thermostat really did after a write instead of waiting for the next
+        long poll.  Thermostats written close together are fetched together.
+        """
+        if self.reconcile_delay <= 0:
+            return
+        with self.reconcile_lock:
+            self.reconcile_ids.add(thermostatId)
+            if self.reconcile_timer is None:
+                self.reconcile_timer = threading.Timer(self.reconcile_delay,self._reconcile)
+                self.reconcile_timer.daemon = True
+                self.reconcile_timer.start()
+
+    # What a write can change, program and sensors are left for the long poll.
+    _reconcile_includes = {
+        'includeRuntime':         True,
+        'includeEquipmentStatus': True,
+        'includeEvents':          True,
+        'includeSettings':        True,
+    }
+
+    def _reconcile(self):
+        with self.reconcile_lock:
+            ids = self.reconcile_ids
+            self.reconcile_ids   = set()
+            self.reconcile_timer = None
+        nodes = dict()
+        for thermostatId in ids:
+            node = self.nodes.get(self.thermostatIdToAddress(thermostatId))
+            if node is None:
+                continue
+            # Don't overwrite the values of writes still queued, they will reconcile when done.
+            if node.writes.depth > 0:
+                LOGGER.debug("%s:_reconcile: %s has writes queued",self.address,thermostatId)
+                continue
+            nodes[thermostatId] = node
+        if len(nodes) == 0:
+            return
+        if not self.breaker.available():
+            LOGGER.warning("{}:_reconcile: Skipping {} since Ecobee circuit is open".format(self.address,list(nodes)))
+            return
+        if not self.poller.allow():
+            return
+        self.poller.spend()
+        LOGGER.debug("%s:_reconcile: getting %s",self.address,list(nodes))
+        def apply(thermostatId,data):
+            node = nodes[thermostatId]
+            node.update(node.revData,data)
+        with self.session.deadline(time.time() + self.request_budget):
+            for thermostatId in self.fetchSelections([(list(nodes),self._reconcile_includes)],apply):
+                LOGGER.warning('_reconcile: Failed to get data for thermostat {}, will be updated on the next poll'.format(thermostatId))
+
+    def changedRevs(self, tstat):
+        """
+        Return the list of revision fields that are different from what was last applied.
+        """
+        return self.revs.changed(tstat)
+
+    # Weather is not covered by any revision, so refresh it at most this often.
+    _weather_interval = 900
+
+    # Revisions of the alerts and the 5 minute interval data, which the nodes don't use.
+    _unused_revs = ('alertsRev','intervalRev')
+
+    def getSelectionIncludes(self, revs, node):
+        """
+        Figure out which selection sections need to be requested for a
+        thermostat based on the list of revisions that changed.
+          thermostatRev: program, settings or events (holds) changed
+          runtimeRev:    equipment status, sensor readings or runtime changed
+        alertsRev and intervalRev are not fetched, see _unused_revs.
+        """
+        includes = dict()
+        if 'thermostatRev' in revs:
+            includes['includeSettings'] = True
+            includes['includeProgram']  = True
+            includes['includeEvents']   = True
+        if 'runtimeRev' in revs:
+            includes['includeRuntime']         = True
+            includes['includeEquipmentStatus'] = True
+            includes['includeSensors']         = True
+            # Holds ending are reported with the runtime changes
+            includes['includeEvents']          = True
+        if node.do_weather is not False and ('thermostatRev' in revs or node.weatherAge() > self._weather_interval):
+            includes['includeWeather'] = True
+        return includes
 
     def query(self):
         self.reportDrivers()
@@ -525,6 +784,14 @@ class Controller(Controller):
 
     def stop(self):
         LOGGER.debug('NodeServer stoping...')
+        self.tokens.stop()
+        # Send any commands that are still queued, all at once and within 10 seconds total.
+        writes = [node.writes for node in list(self.nodes.values()) if getattr(node,'writes',None) is not None]
+        for nwrites in writes:
+            nwrites.signal()
+        end = time.time() + 10
+        for nwrites in writes:
+            nwrites.join(max(0,end - time.time()))
         self.set_ecobee_st(False)
 
     def thermostatIdToAddress(self,tid):
@@ -549,150 +816,131 @@ class Controller(Controller):
         LOGGER.info('Discovering Ecobee Thermostats')
         if not 'access_token' in self.tokenData:
             return False
-        self.revData = {} # Intialize in case we fail
         thermostats = self.getThermostats()
         if thermostats is False:
             LOGGER.error("Discover Failed, No thermostats returned!  Will try again on next long poll")
             return False
-        self.revData = deepcopy(thermostats)
+        #
+        # Get all the data for new thermostats at once, this is used for
+        # the profile check and to create the nodes.
+        #
+        new_ids = [tid for tid in thermostats if not self.thermostatIdToAddress(tid) in self.nodes]
+        fullData = self.getThermostatsFull(new_ids) if len(new_ids) > 0 else dict()
         #
         # Build or update the profile first.
         #
-        self.check_profile(thermostats)
+        self.check_profile(thermostats,fullData)
         #
         # Now add our thermostats
         #
         for thermostatId, thermostat in thermostats.items():
             address = self.thermostatIdToAddress(thermostatId)
             if not address in self.nodes:
-                fullData = self.getThermostatFull(thermostatId)
-                if fullData is not False:
-                    tstat = fullData['thermostatList'][0]
+                if thermostatId in fullData:
+                    tstat = fullData[thermostatId]['thermostatList'][0]
                     useCelsius = True if tstat['settings']['useCelsius'] else False
+                    # The node keeps what it needs, so the raw data can go.
                     self.addNode(Thermostat(self, address, address, thermostatId,
                                             'Ecobee - {}'.format(get_valid_node_name(thermostat['name'])),
-                                            thermostat, fullData, useCelsius))
+                                            thermostat, fullData.pop(thermostatId), useCelsius))
+                    # The node starts with this data, so these revisions are current.
+                    self.revs.applied(thermostat)
+                else:
+                    LOGGER.error("_discover: No data returned for thermostat {} '{}'".format(thermostatId,thermostat['name']))
         return True
 
-    def check_profile(self,thermostats):
+    def check_profile(self,thermostats,fullData):
+        """
+        fullData is the thermostatId to data dict that discovery retrieved,
+        thermostats we already have nodes for use the program they have.
+        The climates are saved with the thermostatRev of the program they
+        came from, and the program can only change when thermostatRev does,
+        so they are only looked at again for thermostats where it moved.
+        """
         self.profile_info = get_profile_info(LOGGER)
+        # The templates are only compiled once.
+        if self.profile is None:
+            self.profile = profileBuilder(LOGGER,climateList)
+        cdata = self.store.view()
+        LOGGER.info('check_profile: profile_info={}'.format(self.profile_info))
+        stored = cdata.get('climates',{})
         #
-        # First get all the climate programs so we can build the profile if necessary
+        # First get the climates for the thermostats with a new program
         #
         climates = dict()
         for thermostatId, thermostat in thermostats.items():
-            # Only get program data if we have the node.
-            fullData = self.getThermostatSelection(thermostatId,includeProgram=True)
-            if fullData is not False:
-                programs = fullData['thermostatList'][0]['program']
-                climates[thermostatId] = list()
-                for climate in programs['climates']:
-                    climates[thermostatId].append({'name': climate['name'], 'ref':climate['climateRef']})
+            current = stored.get(thermostatId)
+            # Saved before they had the revision
+            if isinstance(current,list):
+                current = { 'rev': None, 'climates': current }
+            programs = None
+            if thermostatId in fullData:
+                programs = fullData[thermostatId]['thermostatList'][0]['program']
+                rev = thermostat['thermostatRev']
+            else:
+                address = self.thermostatIdToAddress(thermostatId)
+                if address in self.nodes:
+                    programs = self.nodes[address].program
+                    # The revision the node's program came from
+                    rev = self.revs.get(thermostatId,'thermostatRev')
+            if current is not None and (programs is None or current['rev'] == rev):
+                climates[thermostatId] = current
+            elif programs is not None:
+                LOGGER.debug("check_profile: %s thermostatRev %s",thermostatId,rev)
+                climates[thermostatId] = {
+                    'rev': rev,
+                    'climates': [{'name': climate['name'], 'ref':climate['climateRef']} for climate in programs['climates']]
+                }
+        #
+        # Index the climates, and save the index of climates not in climateList.
+        #
+        registries = dict()
+        for thermostatId in climates:
+            registries[thermostatId] = self.getClimateRegistry(thermostatId,climates[thermostatId]['climates'])
+            if climates[thermostatId].get('extra',[]) != registries[thermostatId].extra:
+                climates[thermostatId] = dict(climates[thermostatId],extra=registries[thermostatId].extra)
         LOGGER.debug("check_profile: climates={}".format(climates))
         #
-        # Set Default profile version if not Found
+        # Build the profile, and only install it if it's different from last time.
         #
-        cdata = deepcopy(self.polyConfig['customData'])
-        LOGGER.info('check_profile: profile_info={}'.format(self.profile_info))
-        LOGGER.info('check_profile:   customData={}'.format(cdata))
-        if not 'profile_info' in cdata:
-            update_profile = True
-        elif self.profile_info['version'] == cdata['profile_info']['version']:
-            # Check if the climates are different
-            update_profile = False
-            LOGGER.info('check_profile: update_profile={} checking climates.'.format(update_profile))
-            if 'climates' in cdata:
-                current = cdata['climates']
-                if not update_profile:
-                    # Check if the climates have changed.
-                    for id in climates:
-                        if id in current:
-                            if len(climates[id]) == len(current[id]):
-                                for i in range(len(climates[id])):
-                                    if climates[id][i] != current[id][i]:
-                                        update_profile = True
-                            else:
-                                update_profile = True
-                        else:
-                            update_profile = True
-            else:
-                update_profile = True
-        else:
-            update_profile = True
-        LOGGER.warning('check_profile: update_profile={}'.format(update_profile))
+        files = self.profile.render(registries)
+        self.profile_ids = self.profile.profile_ids(registries)
+        LOGGER.debug("check_profile: profile_ids={}".format(self.profile_ids))
+        profile_hash = self.profile.hash(files)
+        update_profile = profile_hash != cdata.get('profile_hash')
+        LOGGER.warning('check_profile: update_profile={} hash={}'.format(update_profile,profile_hash))
+        # Make sure the files are there for Upload Profile.
+        self.profile.write(files)
         if update_profile:
-            self.write_profile(climates)
             self.poly.installprofile()
-            cdata['profile_info'] = self.profile_info
-            cdata['climates'] = climates
-            self.saveCustomDataWait(cdata)
-
-    def write_profile(self,climates):
-      pfx = '{}:write_profile:'.format(self.address)
-      #
-      # Start the nls with the template data.
-      #
-      en_us_txt = "profile/nls/en_us.txt"
-      make_file_dir(en_us_txt)
-      LOGGER.info("{0} Writing {1}".format(pfx,en_us_txt))
-      nls_tmpl = open("template/en_us.txt", "r")
-      nls      = open(en_us_txt,  "w")
-      for line in nls_tmpl:
-        nls.write(line)
-      nls_tmpl.close()
-      # Open the nodedef custom for writing
-      nodedef_f = 'profile/nodedef/custom.xml'
-      LOGGER.info("{0} Writing {1}".format(pfx,nodedef_f))
-      nodedef_h = open(nodedef_f, "w")
-      nodedef_h.write('<nodedefs>\n')
-      # Open the editor custom for writing
-      editor_f = 'profile/editor/custom.xml'
-      LOGGER.info("{0} Writing {1}".format(pfx,editor_f))
-      editor_h = open(editor_f, "w")
-      editor_h.write('<editors>\n')
-      for id in climates:
-        # Read thermostat template to write the custom version.
-        in_h  = open('template/thermostat.xml','r')
-        for line in in_h:
-            nodedef_h.write(re.sub(r'tstatid',r'{0}'.format(id),line))
-        in_h.close()
-        # Read the editor template to write the custom version
-        in_h  = open('template/editors.xml','r')
-        for line in in_h:
-            line = re.sub(r'tstatid',r'{0}'.format(id),line)
-            line = re.sub(r'tstatcnta',r'{0}'.format(len(climateList)-1),line)
-            # This is minus 3 because we don't allow selecting vacation or smartAway, ...
-            # But not currently using this because we don't have different list for
-            # status and programs?
-            line = re.sub(r'tstatcnt',r'{0}'.format(len(climateList)-5),line)
-            editor_h.write(line)
-        in_h.close()
-        # Then the NLS lines.
-        nls.write("\n")
-        nls.write('ND-EcobeeC_{0}-NAME = Ecobee Thermostat {0} (C)\n'.format(id))
-        nls.write('ND-EcobeeC_{0}-ICON = Thermostat\n'.format(id))
-        nls.write('ND-EcobeeF_{0}-NAME = Ecobee Thermostat {0} (F)\n'.format(id))
-        nls.write('ND-EcobeeF_{0}-ICON = Thermostat\n'.format(id))
-        # ucfirst them all
-        customList = list()
-        for i in range(len(climateList)):
-            customList.append(climateList[i][0].upper() + climateList[i][1:])
-        # Now see if there are custom names
-        for i in range(len(climateList)):
-            name = climateList[i]
-            # Find this name in the map and replace with our name.
-            for cli in climates[id]:
-                if cli['ref'] == name:
-                    customList[i] = cli['name']
-        LOGGER.debug("{} customList={}".format(pfx,customList))
-        for i in range(len(customList)):
-            nls.write("CT_{}-{} = {}\n".format(id,i,customList[i]))
-      nodedef_h.write('</nodedefs>\n')
-      nodedef_h.close()
-      editor_h.write('</editors>\n')
-      editor_h.close()
-      nls.close()
-      LOGGER.info("{} done".format(pfx))
+        if update_profile or climates != stored:
+            self.updateCustomData({'profile_info': self.profile_info, 'climates': climates, 'profile_hash': profile_hash})
+        # Thermostats whose climate names changed now use another nodedef.
+        for thermostatId, profileId in self.profile_ids.items():
+            node = self.nodes.get(self.thermostatIdToAddress(thermostatId))
+            if node is not None and node.setProfileId(profileId):
+                LOGGER.warning("check_profile: {} nodedef changed to {}".format(thermostatId,node.id))
+                self.addNode(node)
+
+    def getClimateRegistry(self,thermostatId,climates):
+        """
+        The climateRegistry for the program climates of thermostatId, keeping
+        the index saved for each climate that isn't in climateList.
+        """
+        current = self.store.get('climates',{}).get(thermostatId)
+        extra = current.get('extra',[]) if isinstance(current,dict) else []
+        return climateRegistry(climates,extra)
+
+    def profileId(self,thermostatId,climates):
+        """
+        The id used for the shared nodedef of thermostatId, from the last
+        profile that was built or else from its climateRegistry climates.
+        """
+        if thermostatId in self.profile_ids:
+            return self.profile_ids[thermostatId]
+        if self.profile is None:
+            self.profile = profileBuilder(LOGGER,climateList)
+        return self.profile.fingerprint(climates)
 
     # Calls session.get and converts params to weird ecobee formatting.
     def session_get (self,path,data):
@@ -700,14 +948,15 @@ class Controller(Controller):
             # All calls before with have auth token, don't reformat with json
             return self.session.get(path,data)
         else:
+            tokenData = self.tokenData
             res = self.session.get(path,{ 'json': json.dumps(data) },
-                                    auth='{} {}'.format(self.tokenData['token_type'], self.tokenData['access_token'])
+                                    auth='{} {}'.format(tokenData['token_type'], tokenData['access_token'])
                                     )
             if res is False:
                 return res
             if res['data'] is False:
                 return False
-            self.l_debug('session_get', 0, 'res={}'.format(res))
+            self.l_debug('session_get', 0, 'res={}', res)
             if not 'status' in res['data']:
                 return res
             res_st_code = int(res['data']['status']['code'])
@@ -716,10 +965,11 @@ class Controller(Controller):
             LOGGER.error('Checking Bad Status Code {} for {}'.format(res_st_code,res))
             if res_st_code == 14:
                 self.l_error('session_get', 'Token has expired, will refresh')
-                # TODO: Should this be a loop instead ?
-                if self._getRefresh() is True:
+                # Only one refresh runs even if many requests get this at once.
+                if self.tokens.refresh(stale=tokenData) is True:
+                    tokenData = self.tokenData
                     return self.session.get(path,{ 'json': json.dumps(data) },
-                                     auth='{} {}'.format(self.tokenData['token_type'], self.tokenData['access_token']))
+                                     auth='{} {}'.format(tokenData['token_type'], tokenData['access_token']))
             elif res_st_code == 16:
                 self._reAuth("session_get: Token deauthorized by user: {}".format(res))
             return False
@@ -750,22 +1000,101 @@ class Controller(Controller):
         if 'revisionList' in res_data:
             if res_data['revisionList'] is False:
                 self.l_error('getThermostats','Ecobee returned code {} but no revisionList? ({})'.format(res_code,res_data['revisionList']))
-            for thermostat in res_data['revisionList']:
-                revisionArray = thermostat.split(':')
-                thermostats['{}'.format(revisionArray[0])] = {
-                    'name': revisionArray[1],
-                    'thermostatId': revisionArray[0],
-                    'connected': revisionArray[2],
-                    'thermostatRev': revisionArray[3],
-                    'alertsRev': revisionArray[4],
-                    'runtimeRev': revisionArray[5],
-                    'intervalRev': revisionArray[6]
-                }
+            thermostats = revisionRecord.parse_list(res_data['revisionList'])
         return thermostats
 
     def getThermostatFull(self, id):
         return self.getThermostatSelection(id,True,True,True,True,True,True,True,True,True,True,True,True)
 
+    def getThermostatsFull(self, ids):
+        return self.getThermostatsSelection(ids,**self._full_selection)
+
+    _full_selection = {
+        'includeEvents': True,
+        'includeProgram': True,
+        'includeSettings': True,
+        'includeRuntime': True,
+        'includeEquipmentStatus': True,
+        'includeWeather': True,
+        'includeSensors': True
+    }
+
+    # Maximum number of thermostats Ecobee will return in one page.
+    _batch_size = 25
+
+    def getThermostatsSelection(self,ids,**kwargs):
+        """
+        Get the selection for a list of thermostat ids using as few requests
+        as possible.  Returns a dict of thermostatId to data in the same format
+        getThermostatSelection returns for a single thermostat, so it can be
+        passed directly to Thermostat.update.
+        Thermostats that failed to be fetched are not in the returned dict.
+        """
+        ret = dict()
+        def store(thermostatId,data):
+            ret[thermostatId] = data
+        self.fetchSelections([(ids,kwargs)],store)
+        return ret
+
+    def fetchSelections(self,jobs,callback):
+        """
+        Run a list of (ids, includes) fetch jobs on the session workers.  The ids
+        are split into batches and all batches are run at the same time, then
+        callback(thermostatId,data) is called in this thread for each
+        thermostat as the results come back.  Each batch must finish within
+        fetch_timeout seconds of when it starts, or by the deadline of this
+        thread if that's sooner, and a batch that fails or runs out of time
+        only affects its thermostats.
+        Returns the list of thermostat ids that were not returned.
+        """
+        # Make sure tokens are good before the workers all try to use them.
+        if not self._checkTokens():
+            LOGGER.error('fetchSelections failed. Couldn\'t get tokens.')
+            return [tid for ids, includes in jobs for tid in ids]
+        # The workers get the same deadline as this thread.
+        deadline = self.session.current_deadline()
+        def fetch(chunk,includes):
+            # The session ends the request itself when it's out of time, so a
+            # stuck batch doesn't hold the worker.
+            ts = time.time() + self.fetch_timeout
+            with self.session.deadline(ts if deadline is None else min(ts,deadline)):
+                return self.getThermostatSelection(','.join(chunk),**includes)
+        futures = dict()
+        for ids, includes in jobs:
+            ids = list(ids)
+            for i in range(0, len(ids), self.fetch_batch):
+                chunk = ids[i:i+self.fetch_batch]
+                futures[self.session.submit(fetch,chunk,includes)] = chunk
+        missing = list()
+        for future in concurrent.futures.as_completed(futures):
+            chunk = futures[future]
+            try:
+                data = future.result()
+            except Exception as e:
+                self.l_error('fetchSelections','Failed to get data for {}: {}'.format(chunk,e),True)
+                missing.extend(chunk)
+                continue
+            if data is False or data is None:
+                LOGGER.error('fetchSelections: Failed to get data for {}'.format(chunk))
+                missing.extend(chunk)
+                continue
+            if not 'thermostatList' in data:
+                LOGGER.error('fetchSelections: No thermostatList for {} in {}'.format(chunk,data))
+                missing.extend(chunk)
+                continue
+            got = list()
+            # Take each one off the list so it's released once it's applied.
+            tlist = data['thermostatList']
+            while len(tlist) > 0:
+                tstat = tlist.pop(0)
+                got.append(tstat['identifier'])
+                try:
+                    callback(tstat['identifier'],{ 'thermostatList': [tstat] })
+                except Exception as e:
+                    self.l_error('fetchSelections','Failed to apply data for {}: {}'.format(tstat['identifier'],e),True)
+            missing.extend([tid for tid in chunk if not tid in got])
+        return missing
+
     def getThermostatSelection(self,id,
                                includeEvents=False,
                                includeProgram=False,
@@ -804,13 +1133,16 @@ class Controller(Controller):
                                        }
                                }
                            )
-        self.l_debug('getThermostatSelection',0,'done'.format(id))
-        self.l_debug('getThermostatSelection',1,'data={}'.format(res))
+        self.l_debug('getThermostatSelection',0,'done {}',id)
+        self.l_debug('getThermostatSelection',1,'data={}',res)
         if res is False or res is None:
             return False
         return res['data']
 
     def ecobeePost(self, thermostatId, postData = {}):
+        if not self.breaker.available():
+            LOGGER.error('ecobeePost: Rejecting update for {} since Ecobee circuit is open'.format(thermostatId))
+            return False
         if not self._checkTokens():
             LOGGER.error('ecobeePost failed. Tokens not available.')
             return False
@@ -819,10 +1151,10 @@ class Controller(Controller):
             'selectionType': 'thermostats',
             'selectionMatch': thermostatId
         }
+        tokenData = self.tokenData
         res = self.session.post('1/thermostat',params={'json': 'true'},payload=postData,
-            auth='{} {}'.format(self.tokenData['token_type'], self.tokenData['access_token']),dump=True)
+            auth='{} {}'.format(tokenData['token_type'], tokenData['access_token']),dump=True)
         if res is False:
-            self.refreshingTokens = False
             self.set_ecobee_st(False)
             return False
         self.set_ecobee_st(True)
@@ -871,7 +1203,7 @@ class Controller(Controller):
     _data_lock = '_data_lock'
     _lock_fmt  = '%Y-%m-%dT%H:%M:%S.%f'
     def lockCustomData(self):
-        cdata = deepcopy(self.polyConfig['customData'])
+        cdata = self.store.view()
         # Now see if someone is trying to refresh it.
         lock = cdata.get(self._data_lock)
         rval = False
@@ -892,14 +1224,37 @@ class Controller(Controller):
                     LOGGER.error("But their attempt was {} seconds ago, so we will grab the lock...".format(ts_diff.total_seconds()))
                     rval = True
         if (rval):
-            rval = self.saveCustomDataWait(cdata,lock=True)
+            rval = self.updateCustomData(lock=True)
         return rval
 
     # This holds the last date time we did saveCustomData
     _data_tag  = '_data_dtm'
+    def updateCustomData(self,changes=None,delete=(),lock=False,timeout=10):
+        """
+        Apply the changes to customData and save it, if anything changed.
+        See saveCustomDataWait for lock.
+        """
+        changes = dict() if changes is None else dict(changes)
+        # Old stuff
+        delete = list(delete) + ['pinData','refresh_status']
+        # lock=None means do nothing to the lock.
+        if lock is not None:
+            # If True then set to curent date/time
+            # Otherwise set to what they desired, typically False
+            changes[self._data_lock] = datetime.now().strftime(self._lock_fmt) if lock else lock
+        prev  = self.store.view()
+        ndata = self.store.apply(changes,delete)
+        if ndata is None:
+            LOGGER.debug("updateCustomData: nothing changed, not saving")
+            return True
+        if self.saveCustomDataWait(dict(ndata),lock=None,timeout=timeout):
+            return True
+        # Polyglot doesn't have it, so go back to what it does have.
+        self.store.rollback(prev,ndata)
+        return False
+
     def saveCustomDataWait(self,ndata,lock=False,timeout=10):
         dtns = datetime.now().strftime(self._lock_fmt)
-        ndata[self._data_tag] = dtns
         LOGGER.info("saveCustomData: {}".format(dtns))
         # Old stuff
         if 'pinData' in ndata:
@@ -911,41 +1266,39 @@ class Controller(Controller):
             # If True then set to curent date/time
             # Otherwise set to what they desired, typically False
             ndata[self._data_lock] = dtns if lock else lock
-        # Save it...
-        done = False
-        tcnt = 0
-        while (not done):
-            tcnt += 1
-            LOGGER.info("Sending try={}\n{}={}\n{}={}\ntokenData=".format(tcnt,self._data_tag,ndata[self._data_tag],self._data_lock,ndata[self._data_lock]))
-            if 'tokenData' in ndata:
-                LOGGER.info("tokenData="+json.dumps(ndata['tokenData'],sort_keys=True,indent=2))
-            self.saveCustomData(ndata)
-            cnt = 0
-            while (not done and cnt < 900):
-                cd = deepcopy(self.polyConfig['customData'])
-                if cd.get(self._data_tag) == dtns:
-                    done = True
-                else:
-                    LOGGER.info("Waiting for custom data save to happen {}={} expecting {}".format(self._data_tag,cd.get(self._data_tag),dtns))
-                    time.sleep(1)
-                    cnt += 1
-            if (done):
-                self._last_dtns = dtns
-                # IF we set auth false then set it back to true
-                if (tcnt > 1):
-                    self.set_auth_st(True)
-            else:
-                LOGGER.error("This may cause problems... timeout waiting for custom data save to happen {}={} expecting {}".format(self._data_tag,cd.get(self._data_tag),dtns))
-                # No idea what to do in this case?  For now set auto false so can trigger a failure...
-                self.set_auth_st(False)
-        LOGGER.info("Done\n{}={}\n{}={}".format(self._data_tag,cd[self._data_tag],self._data_lock,cd[self._data_lock]))
-        if 'tokenData' in cd:
-            LOGGER.info("tokenData="+json.dumps(cd['tokenData'],sort_keys=True,indent=2))
+        if 'tokenData' in ndata:
+            LOGGER.debug("tokenData=%s",lazyJson(ndata['tokenData']))
+        # Save it, this waits until Polyglot sends it back, see process_config.
+        saved = self.saver.save(ndata,timeout=timeout)
+        if saved is False:
+            LOGGER.error("This may cause problems... custom data save did not happen")
+            # No idea what to do in this case?  For now set auth false so can trigger a failure...
+            self.set_auth_st(False)
+            self._save_failed = True
+            return False
+        self._last_dtns = saved
+        # IF we set auth false then set it back to true
+        if self._save_failed:
+            self._save_failed = False
+            self.set_auth_st(True)
+        cd = self.polyConfig['customData']
+        LOGGER.info("Done {}={} {}={} in {:.3f} seconds (average {:.3f})".format(self._data_tag,cd.get(self._data_tag),self._data_lock,cd.get(self._data_lock),
+                                                                              self.saver.latency[-1],self.saver.average_latency()))
         return True
 
+    def process_config(self, config):
+        # Called by polyinterface with each new config, let anyone waiting on a save know.
+        cdata = config.get('customData',{})
+        # An older config would undo changes we applied and are still saving.
+        if self.saver.stale(cdata):
+            LOGGER.debug("process_config: ignoring customData %s=%s older than the last save",self._data_tag,cdata.get(self._data_tag))
+        else:
+            self.store.config(cdata)
+        self.saver.config(cdata)
+
     def cmd_poll(self,  *args, **kwargs):
         LOGGER.debug("{}:cmd_poll".format(self.address))
-        self.updateThermostats(force=True)
+        self.pollThermostats(int(self.polyConfig['longPoll']),force=True)
         self.query()
 
     def cmd_query(self, *args, **kwargs):
@@ -967,16 +1320,18 @@ class Controller(Controller):
     # This is to manually test Issue #57
     def cmd_test_refresh(self,  *args, **kwargs):
         LOGGER.debug("{}".format(self.address))
-        self._getRefresh(test=True)
+        self.tokens.refresh(test=True)
 
     # This locks the DB, to test the auto-unlock timout feature for an old lock
     def cmd_test_lock(self,  *args, **kwargs):
         LOGGER.debug("{}".format(self.address))
         self.lockCustomData()
 
-    def set_all_logs(self,level):
+    # Each subsystem has it's own logger, pgSession is only debug when
+    # session debug is requested since it's so verbose.
+    def set_all_logs(self,level,session_level=None):
         self.l_info("set_all_logs",level)
-        LOGGER.setLevel(level)
+        set_levels(polyinterface.LOGGER,level,session_level)
         #logging.getLogger('requests').setLevel(level)
         #logging.getLogger('urllib3').setLevel(level)
 
@@ -997,12 +1352,12 @@ class Controller(Controller):
             self.l_error('set_debug_mode','setDriver(GV2) failed',True)
         self.debug_level = 0
         if level < 20:
-            self.set_all_logs(logging.DEBUG)
             # 9 & 8 incrase pgsession debug level
             if level == 9:
                 self.debug_level = 1
             elif level == 8:
                 self.debug_level = 2
+            self.set_all_logs(logging.DEBUG,logging.DEBUG if level < 10 else logging.INFO)
         elif level <= 20:
             self.set_all_logs(logging.INFO)
         elif level <= 30:
@@ -1013,30 +1368,65 @@ class Controller(Controller):
             self.set_all_logs(logging.CRITICAL)
         else:
             self.l_error("set_debug_mode","Unknown level {0}".format(level))
-        self.l_info("set_debug_mode"," session debug_level={}".format(self.debug_level))
+        if getattr(self,'session',None) is not None:
+            self.session.debug_level = self.debug_level
+        self.l_info("set_debug_mode"," session debug_level={}",self.debug_level)
 
     def set_ecobee_st(self,val):
       ival = 1 if val else 0
       LOGGER.debug("{}:set_ecobee_st: {}={}".format(self.address,val,ival))
       self.setDriver('GV1',ival)
 
+    _breaker_state = circuitBreaker.CLOSED
+    def set_breaker_st(self,breaker):
+      LOGGER.debug("{}:set_breaker_st: state={} failures={} rejected={}".format(self.address,breaker.state_names[breaker.state],breaker.failures,breaker.rejected))
+      if breaker.state != self._breaker_state:
+        self._breaker_state = breaker.state
+        if breaker.state == breaker.OPEN:
+          self.addNotice({'circuit': 'Ecobee servers are not responding, requests will be retried every {} seconds. Check system status: https://status.ecobee.com/'.format(breaker.delay)})
+        elif breaker.state == breaker.CLOSED:
+          self.removeNotice('circuit')
+      self.setDriver('GV4',breaker.state)
+      self.setDriver('GV5',breaker.failures)
+      self.setDriver('GV6',breaker.rejected)
+
+    def set_writes_st(self,writes=None):
+      # Totals for the command queues of all thermostats
+      depth = 0
+      latency = list()
+      for node in list(self.nodes.values()):
+        nwrites = getattr(node,'writes',None)
+        if nwrites is not None:
+          depth += nwrites.depth
+          avg = nwrites.average_latency()
+          if avg is not None:
+            latency.append(avg)
+      # Average of the thermostats that have sent commands
+      avg = int(sum(latency) * 1000 / len(latency)) if len(latency) > 0 else 0
+      LOGGER.debug("%s:set_writes_st: depth=%s latency=%sms",self.address,depth,avg)
+      self.setDriver('GV7',depth)
+      self.setDriver('GV8',avg)
+
     def set_auth_st(self,val):
       ival = 1 if val else 0
       LOGGER.debug("{}:set_auth_st: {}={}".format(self.address,val,ival))
       self.setDriver('GV3',ival)
 
-    def l_info(self, name, string):
-        LOGGER.info("%s:%s:%s: %s" %  (self.id,self.name,name,string))
+    # string is only formatted with args if the level is enabled.
+    def l_info(self, name, string, *args):
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info("%s:%s:%s: %s" %  (self.id,self.name,name,string.format(*args) if args else string))
 
     def l_error(self, name, string, exc_info=False):
         LOGGER.error("%s:%s:%s: %s" % (self.id,self.name,name,string), exc_info=exc_info)
 
-    def l_warning(self, name, string):
-        LOGGER.warning("%s:%s:%s: %s" % (self.id,self.name,name,string))
+    def l_warning(self, name, string, *args):
+        if LOGGER.isEnabledFor(logging.WARNING):
+            LOGGER.warning("%s:%s:%s: %s" % (self.id,self.name,name,string.format(*args) if args else string))
 
-    def l_debug(self, name, level, string, exc_info=False):
-        if level <= self.debug_level:
-            LOGGER.debug("%s:%s:%s: %s" % (self.id,self.name,name,string), exc_info=exc_info)
+    def l_debug(self, name, level, string, *args, exc_info=False):
+        if level <= self.debug_level and LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("%s:%s:%s: %s" % (self.id,self.name,name,string.format(*args) if args else string), exc_info=exc_info)
 
     id = 'ECO_CTR'
     commands = {
@@ -1052,5 +1442,10 @@ class Controller(Controller):
         {'driver': 'ST', 'value': 1, 'uom': 2},
         {'driver': 'GV1', 'value': 0, 'uom': 2},
         {'driver': 'GV2', 'value': 30, 'uom': 25},
-        {'driver': 'GV3', 'value': 0, 'uom': 2}
+        {'driver': 'GV3', 'value': 0, 'uom': 2},
+        {'driver': 'GV4', 'value': 0, 'uom': 25},
+        {'driver': 'GV5', 'value': 0, 'uom': 56},
+        {'driver': 'GV6', 'value': 0, 'uom': 56},
+        {'driver': 'GV7', 'value': 0, 'uom': 56},
+        {'driver': 'GV8', 'value': 0, 'uom': 42}
     ]
@@ -8,8 +8,63 @@ except ImportError:
 from copy import deepcopy
 from const import driversMap
 from node_funcs import *
+from pgLog import getLogger
+from driverCache import driverCache
 
-class Sensor(Node):
+LOGGER = getLogger(LOGGER,'Sensor')
+
+#
+# Decoders for the Ecobee sensor capabilities.  Each one is a function that
+# is passed the sensor node once when it's created, and returns the function
+# that sets the driver values in updates for a capability value.
+#
+def decode_temperature(node):
+    useCelsius = node.parent.useCelsius
+    def decode(val,updates):
+        # temperature unknown seems to mean the sensor is not responding.
+        if val == 'unknown':
+            updates['GV2'] = 0
+            return
+        updates['GV2'] = 1
+        try:
+            temp = float(val)
+        except ValueError:
+            LOGGER.error("%s:update: Unable to convert temperature '%s' to float",node.address,val)
+            return
+        if temp != 0:
+            temp = temp / 10
+        updates['ST'] = toC(temp) if useCelsius else temp
+    return decode
+
+def decode_bool(driver):
+    values = { 'true': 1, 'false': 0 }
+    def factory(node):
+        def decode(val,updates):
+            updates[driver] = values.get(val,val)
+        return decode
+    return factory
+
+def decode_value(driver):
+    def factory(node):
+        def decode(val,updates):
+            updates[driver] = val
+        return decode
+    return factory
+
+# Capability type to the drivers it sets and its decoder.  A capability is
+# only decoded for nodes that have one of its drivers, so new ones can be
+# added here before the profile has the drivers for them.
+capabilityDecoders = {
+    'temperature': (('ST','GV2'), decode_temperature),
+    'humidity':    (('CLIHUM',),  decode_value('CLIHUM')),
+    'occupancy':   (('GV1',),     decode_bool('GV1')),
+    'dryContact':  (('GV3',),     decode_value('GV3')),
+    'co2':         (('CO2LVL',),  decode_value('CO2LVL')),
+    'vocPPM':      (('VOCLVL',),  decode_value('VOCLVL')),
+    'airPressure': (('BARPRES',), decode_value('BARPRES')),
+}
+
+class Sensor(driverCache,Node):
     def __init__(self, controller, primary, address, name, id, parent):
       super().__init__(controller, primary, address, name)
       self.type = 'sensor'
@@ -17,45 +72,40 @@ class Sensor(Node):
       self.parent = parent
       self.id = id
       self.drivers = self._convertDrivers(driversMap[self.id]) if self.controller._cloud else deepcopy(driversMap[self.id])
+      self.compileDecoders()
+
+    def compileDecoders(self):
+      """
+      Build the capability type to decoder table for the drivers this node has.
+      """
+      drivers = set(self.drivers) if isinstance(self.drivers,dict) else set([d['driver'] for d in self.drivers])
+      self.decoders = dict()
+      # Capabilities this node doesn't show, and unknown ones already logged
+      self.ignored = set()
+      for ctype, (cdrivers, factory) in capabilityDecoders.items():
+        if drivers.intersection(cdrivers):
+          self.decoders[ctype] = factory(self)
+        else:
+          self.ignored.add(ctype)
+      # Default is N/A
+      self.defaults = { 'GV1': 2 } if 'GV1' in drivers else dict()
 
     def start(self):
       self.query()
 
     def update(self, sensor):
-      LOGGER.debug("{}:update:".format(self.address))
-      LOGGER.debug("{}:update: sensor={}".format(self.address,sensor))
-      updates = {
-          'GV1': 2 # Default is N/A
-      }
-      # Cross reference from sensor capabilty to driver
-      xref = {
-          'temperature': 'ST',
-          'humidity': 'CLIHUM',
-          'occupancy': 'GV1',
-          'responding': 'GV2',
-          'dryContact': 'GV3'
-      }
+      LOGGER.debug("%s:update: sensor=%s",self.address,sensor)
+      updates = dict(self.defaults)
       for item in sensor['capability']:
-          if item['type'] in xref:
-              val = item['value']
-              if val == "true":
-                val = 1
-              elif val == "false":
-                val = 0
-              if item['type'] == 'temperature':
-                # temperature unknown seems to mean the sensor is not responding.s
-                if val == 'unknown':
-                  updates[xref['responding']] = 0
-                else:
-                  updates[xref['responding']] = 1
-                  val = self.parent.tempToDriver(val,True,False)
-              if val is not False:
-                updates[xref[item['type']]] = val
-          else:
-            LOGGER.error("{}:update: Unknown capabilty: {}".format(self.address,item))
-      LOGGER.debug("{}:update: updates={}".format(self.address,updates))
+          decode = self.decoders.get(item['type'])
+          if decode is not None:
+              decode(item['value'],updates)
+          elif not item['type'] in self.ignored:
+              self.ignored.add(item['type'])
+              LOGGER.error("{}:update: Unknown capabilty: {}".format(self.address,item))
+      LOGGER.debug("%s:update: updates=%s",self.address,updates)
       for key, value in updates.items():
-        self.setDriver(key, value)
+        self.set_driver(key, value)
 
     def query(self, command=None):
       self.reportDrivers()
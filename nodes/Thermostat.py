@@ -1,15 +1,25 @@
 import sys
 import re
+import time
+import threading
+from datetime import datetime
 try:
     from polyinterface import Node,LOGGER
 except ImportError:
     from pgc_interface import Node,LOGGER
 from copy import deepcopy
 import json
+import logging
 from node_funcs import *
+from pgLog import getLogger,lazyJson
+from driverCache import driverCache
+from writeCoalescer import writeCoalescer
+from thermostatState import thermostatState
 from nodes import Sensor, Weather
 from const import modeMap,equipmentStatusMap,windMap,transitionMap,fanMap,driversMap
 
+LOGGER = getLogger(LOGGER,'Thermostat')
+
 
 """
  Address scheme:
@@ -20,22 +30,28 @@ from const import modeMap,equipmentStatusMap,windMap,transitionMap,fanMap,driver
  Sensors: n<profile>_s<sensor code> e.g. n003_rs_r6dr
 """
 
-class Thermostat(Node):
+class Thermostat(driverCache,Node):
     def __init__(self, controller, primary, address, thermostatId, name, revData, fullData, useCelsius):
         #LOGGER.debug("fullData={}".format(json.dumps(fullData, sort_keys=True, indent=2)))
         self.controller = controller
         self.name = name
         self.thermostatId = thermostatId
-        self.tstat = fullData['thermostatList'][0]
+        # Only the fields we use are kept, not the whole response.
+        self.tstat = thermostatState(fullData['thermostatList'][0])
         self.program = self.tstat['program']
         self.settings = self.tstat['settings']
+        # Climate ref, index and name lookups for this thermostat
+        self.climates = self.controller.getClimateRegistry(thermostatId,self.program['climates'])
         self.useCelsius = useCelsius
         self.type = 'thermostat'
         self.id = 'EcobeeC' if self.useCelsius else 'EcobeeF'
         self.drivers = self._convertDrivers(driversMap[self.id]) if self.controller._cloud else deepcopy(driversMap[self.id])
-        self.id = '{}_{}'.format(self.id,thermostatId)
+        # Thermostats with the same climate types share a nodedef.
+        self.id = '{}_{}'.format(self.id,self.controller.profileId(thermostatId,self.climates))
         self.revData = revData
-        self.fullData = fullData
+        self.weather_time = time.time() if 'weather' in self.tstat else 0
+        # When tstat was last updated
+        self.update_time = time.time()
         # Will check wether we show weather later
         self.do_weather = None
         self.weather = None
@@ -44,11 +60,18 @@ class Thermostat(Node):
         self._gcidx = {}
         # We track our driver values because we need the value before it's been pushed.
         self.driver = dict()
+        # Held while drivers are changed by commands or updates
+        self.lock = threading.RLock()
+        # Commands are queued, and collected and sent together, see writeCoalescer
+        self.writes = writeCoalescer(self,LOGGER,self.controller.write_window / 1000.0,callback=self.controller.set_writes_st)
+        self.write_notice = False
+        # Ecobee sensor id to our Sensor node, or None if it's not supported, see addSensor
+        self.sensors = dict()
         super(Thermostat, self).__init__(controller, primary, address, name)
 
     def set_driver(self,driver,value):
         self.driver[driver] = value
-        self.setDriver(driver,value)
+        return super(Thermostat, self).set_driver(driver,value)
 
     def get_driver(self,driver):
         if not driver in self.driver:
@@ -63,27 +86,9 @@ class Thermostat(Node):
         if 'remoteSensors' in self.tstat:
             #LOGGER.debug("{}:remoteSensors={}".format(self.address,json.dumps(self.tstat['remoteSensors'], sort_keys=True, indent=2)))
             for sensor in self.tstat['remoteSensors']:
-                if 'id' in sensor and 'name' in sensor:
-                    sensorAddress = self.getSensorAddress(sensor)
-                    if sensorAddress is not None:
-                        # Delete the old one if it exists
-                        sensorAddressOld = self.getSensorAddressOld(sensor)
-                        try:
-                          fonode = self.controller.poly.getNode(sensorAddressOld)
-                        except TypeError:
-                          fonode = False
-                          LOGGER.debug("caught fnode fail due to polyglot cloud bug? assuming old node not found")
-                        if fonode is not False:
-                            self.controller.addNotice({fnode['address']: "Sensor created with new name, please delete old sensor with address '{}' in the Polyglot UI.".format(fnode['address'])})
-                        addS = False
-                        # Add Sensor is necessary
-                        # Did the nodedef id change?
-                        nid = self.get_sensor_nodedef(sensor)
-                        sensorName = get_valid_node_name('Ecobee - {}'.format(sensor['name']))
-                        self.controller.addNode(Sensor(self.controller, self.address, sensorAddress,
-                                                       sensorName, nid, self))
+                self.addSensor(sensor)
         self.check_weather()
-        self.update(self.revData, self.fullData)
+        self.update(self.revData)
         self.query()
 
     def check_weather(self):
@@ -122,6 +127,46 @@ class Thermostat(Node):
                 self.forcast = None
 
 
+    def addSensor(self,sensor):
+        """
+        Add the node for the Ecobee sensor data and put it in our sensor
+        index.  Returns the node, or None if it can't be added.
+        """
+        if not ('id' in sensor and 'name' in sensor):
+            return None
+        # Remember the ones that can't be added so they are not tried again on every update.
+        self.sensors[sensor['id']] = None
+        sensorAddress = self.getSensorAddress(sensor)
+        if sensorAddress is None:
+            return None
+        # Delete the old one if it exists
+        sensorAddressOld = self.getSensorAddressOld(sensor)
+        try:
+          fonode = self.controller.poly.getNode(sensorAddressOld)
+        except TypeError:
+          fonode = False
+          LOGGER.debug("caught fnode fail due to polyglot cloud bug? assuming old node not found")
+        if fonode is not False:
+            self.controller.addNotice({fonode['address']: "Sensor created with new name, please delete old sensor with address '{}' in the Polyglot UI.".format(fonode['address'])})
+        # Add Sensor is necessary
+        # Did the nodedef id change?
+        nid = self.get_sensor_nodedef(sensor)
+        if nid is False:
+            return None
+        sensorName = get_valid_node_name('Ecobee - {}'.format(sensor['name']))
+        node = self.controller.addNode(Sensor(self.controller, self.address, sensorAddress,
+                                              sensorName, nid, self))
+        self.sensors[sensor['id']] = node
+        return node
+
+    def removeSensor(self,sensorId):
+        """
+        Forget the sensor, it's no longer on the thermostat.  The node is
+        left since programs may use it.
+        """
+        if self.sensors.pop(sensorId,None) is not None:
+            LOGGER.warning("{}: sensor {} is no longer reported by Ecobee".format(self.address,sensorId))
+
     def get_sensor_nodedef(self,sensor):
         # Given the ecobee sensor data, figure out the nodedef
         # {'id': 'rs:100', 'name': 'Test Sensor', 'type': 'ecobee3_remote_sensor', 'code': 'VRSP', 'inUse': False, 'capability': [{'id': '1', 'type': 'temperature', 'value': 'unknown'}, {'id': '2', 'type': 'occupancy', 'value': 'false'}]}
@@ -152,26 +197,40 @@ class Thermostat(Node):
           HorN = 'H' if has_hum else ''
           return 'EcobeeSensor{}{}'.format(HorN,CorF)
 
-    def update(self, revData, fullData):
+    def update(self, revData, fullData=None):
+      """
+      Apply the data from a thermostat selection, or with no fullData
+      apply the state we already have.
+      """
       self.l_debug('update','')
       #LOGGER.debug("fullData={}".format(json.dumps(fullData, sort_keys=True, indent=2)))
       #LOGGER.debug("revData={}".format(json.dumps(revData, sort_keys=True, indent=2)))
-      if not 'thermostatList' in fullData:
-        self.l_error('update',"No thermostatList in fullData={}".format(json.dumps(fullData, sort_keys=True, indent=2)))
-        return False
+      if fullData is not None:
+        if not 'thermostatList' in fullData:
+          self.l_error('update',"No thermostatList in fullData={}",lazyJson(fullData))
+          return False
+        # Updates may only contain the sections that changed, so merge them
+        # into the data we already have.
+        tstat = fullData['thermostatList'][0]
+        self.tstat.update(tstat)
+        if 'weather' in tstat:
+          self.weather_time = time.time()
+        if 'program' in tstat:
+          self.climates = self.controller.getClimateRegistry(self.thermostatId,self.tstat['program']['climates'])
       self.revData = revData
-      self.fullData = fullData
-      self.tstat = fullData['thermostatList'][0]
-      self.settings = self.tstat['settings']
-      self.program  = self.tstat['program']
-      self.events   = self.tstat['events']
-      self._update()
+      self.update_time = time.time()
+      with self.lock:
+        self.settings = self.tstat['settings']
+        self.program  = self.tstat['program']
+        self.events   = self.tstat['events']
+        self._update()
+      return True
 
     def _update(self):
       equipmentStatus = self.tstat['equipmentStatus'].split(',')
       #LOGGER.debug("settings={}".format(json.dumps(self.settings, sort_keys=True, indent=2)))
       self.runtime = self.tstat['runtime']
-      self.l_debug('_update:',' runtime={}'.format(json.dumps(self.runtime, sort_keys=True, indent=2)))
+      self.l_debug('_update:',' runtime={}',lazyJson(self.runtime))
       clihcs = 0
       for status in equipmentStatus:
         if status in equipmentStatusMap:
@@ -182,20 +241,20 @@ class Thermostat(Node):
       # And the default mode, unless there is an event
       self.clismd = 0
       # Is there an active event?
-      self.l_debug('_update','events={}'.format(json.dumps(self.events, sort_keys=True, indent=2)))
+      self.l_debug('_update','events={}',lazyJson(self.events))
       # Find the first running event
       event_running = False
       for event in self.events:
           if event['running'] and event_running is False:
               event_running = event
-              self.l_debug('_update','running event: {}'.format(json.dumps(event, sort_keys=True, indent=2)))
+              self.l_debug('_update','running event: {}',lazyJson(event))
       if event_running is not False:
         if event_running['type'] == 'hold':
             #LOGGER.debug("Checking: events={}".format(json.dumps(self.events, sort_keys=True, indent=2)))
-            self.l_debug('_update'," #events={} type={} holdClimateRef={}".
-                         format(len(self.events),
-                                event_running['type'],
-                                event_running['holdClimateRef']))
+            self.l_debug('_update'," #events={} type={} holdClimateRef={}",
+                         len(self.events),
+                         event_running['type'],
+                         event_running['holdClimateRef'])
             # This seems to mean an indefinite hold
             #  "endDate": "2035-01-01", "endTime": "00:00:00",
             if event_running['endTime'] == '00:00:00':
@@ -226,7 +285,7 @@ class Thermostat(Node):
         else:
             self.l_error('_update','Unknown event type "{}" name "{}" for event: {}'.format(event_running['type'],event_running['name'],event))
 
-      self.l_debug('_update','climateType={}'.format(climateType))
+      self.l_debug('_update','climateType={}',climateType)
       #LOGGER.debug("program['climates']={}".format(self.program['climates']))
       #LOGGER.debug("settings={}".format(json.dumps(self.settings, sort_keys=True, indent=2)))
       #LOGGER.debug("program={}".format(json.dumps(self.program, sort_keys=True, indent=2)))
@@ -236,11 +295,10 @@ class Thermostat(Node):
         clifrs = 1
       else:
         clifrs = 0
-      self.l_debug('_update','clifrs={} (equipmentStatus={} or clihcs={}, fanControlRequired={}'
-                   .format(clifrs,equipmentStatus,clihcs,self.settings['fanControlRequired'])
-                   )
-      self.l_debug('_update','backlightOnIntensity={} backlightSleepIntensisty={}'.
-                    format(self.settings['backlightOnIntensity'],self.settings['backlightSleepIntensity']))
+      self.l_debug('_update','clifrs={} (equipmentStatus={} or clihcs={}, fanControlRequired={}',
+                   clifrs,equipmentStatus,clihcs,self.settings['fanControlRequired'])
+      self.l_debug('_update','backlightOnIntensity={} backlightSleepIntensisty={}',
+                   self.settings['backlightOnIntensity'],self.settings['backlightSleepIntensity'])
       updates = {
         'ST': self.tempToDriver(self.runtime['actualTemperature'],True,False),
         'CLISPH': self.tempToDriver(self.runtime['desiredHeat'],True),
@@ -262,26 +320,68 @@ class Thermostat(Node):
         'GV11': self.settings['backlightSleepIntensity']
       }
       for key, value in updates.items():
-          self.l_debug('_update','set_driver({},{})'.format(key,value))
+          self.l_debug('_update','set_driver({},{})',key,value)
           self.set_driver(key, value)
 
       # Update my remote sensors.
-      for sensor in self.tstat['remoteSensors']:
-          saddr = self.getSensorAddress(sensor)
-          if saddr in self.controller.nodes:
-              if self.controller.nodes[saddr].primary == self.address:
-                  self.controller.nodes[saddr].update(sensor)
-              else:
-                  LOGGER.debug("{}._update: remoteSensor {} is not mine.".format(self.address,saddr))
+      seen = set()
+      for sensor in self.tstat.get('remoteSensors',list()):
+          seen.add(sensor['id'])
+          if sensor['id'] in self.sensors:
+              node = self.sensors[sensor['id']]
           else:
-              LOGGER.error("{}._update: remoteSensor {} is not in our node list: {}".format(self.address,saddr,self.controller.nodes))
+              # Added on the Ecobee side since we started.
+              LOGGER.info("%s._update: New remoteSensor %s '%s'",self.address,sensor['id'],sensor['name'])
+              node = self.addSensor(sensor)
+          if node is not None:
+              node.update(sensor)
+      for sensorId in [sid for sid in self.sensors if not sid in seen]:
+          self.removeSensor(sensorId)
       self.check_weather()
 
+    # Seconds since we last got weather data
+    def weatherAge(self):
+      return time.time() - self.weather_time
+
+    def setProfileId(self,profileId):
+        """
+        Use the shared nodedef profileId, returns True if it changed.
+        """
+        nid = '{}_{}'.format('EcobeeC' if self.useCelsius else 'EcobeeF',profileId)
+        if nid == self.id:
+            return False
+        self.id = nid
+        return True
+
+    def equipmentRunning(self):
+      return self.tstat.get('equipmentStatus','') != ''
+
+    def holdRemaining(self):
+      """
+      Seconds until the running hold ends, or None if there isn't one or it's indefinite.
+      """
+      for event in self.tstat.get('events',list()):
+        if event['running']:
+          if event['type'] != 'hold' or event['endTime'] == '00:00:00':
+            return None
+          try:
+            # Both are in the thermostat's time zone.
+            now = datetime.strptime(self.tstat['thermostatTime'],'%Y-%m-%d %H:%M:%S')
+            end = datetime.strptime('{} {}'.format(event['endDate'],event['endTime']),'%Y-%m-%d %H:%M:%S')
+          except (KeyError,ValueError) as e:
+            self.l_debug('holdRemaining','Unable to get hold end: {}',e)
+            return None
+          return (end - now).total_seconds() - (time.time() - self.update_time)
+      return None
+
+    def setPollInterval(self,val):
+      self.set_driver('GV12',int(val))
+
     def getClimateIndex(self,name):
-      if name in climateMap:
-          climateIndex = climateMap[name]
-      else:
-        if not name in self._gcidx[name]:
+      climateIndex = self.climates.index_of(name)
+      if climateIndex is None:
+        # Only show the error one time.
+        if not name in self._gcidx:
           LOGGER.error("Unknown climateType='{}' which is a known issue https://github.com/Einstein42/udi-ecobee-poly/issues/63".format(name))
           self._gcidx[name] = True
         climateIndex = climateMap['unknown']
@@ -291,14 +391,14 @@ class Thermostat(Node):
         return self.getClimateDict(self.program['currentClimateRef'])
 
     def getClimateDict(self,name):
-      for cref in self.program['climates']:
-        if name == cref['climateRef']:
-            LOGGER.info('{}:getClimateDict: Returning {}'.format(self.address,cref))
-            return cref
+      cref = self.climates.climate(name)
+      if cref is not None:
+        LOGGER.debug('%s:getClimateDict: Returning %s',self.address,cref)
+        return cref
       # Only show the error one time.
-      if not cref in self._gcde:
-        self._gcde[cref] = True
-        LOGGER.error('{}:getClimateDict: Unknown climateRef name {}'.format(self.address,name),exc_info=True)
+      if not name in self._gcde:
+        self._gcde[name] = True
+        LOGGER.error('{}:getClimateDict: Unknown climateRef name {}'.format(self.address,name))
       return None
 
     def getSensorAddressOld(self,sdata):
@@ -335,23 +435,51 @@ class Thermostat(Node):
     def ecobeePost(self,command):
         return self.controller.ecobeePost(self.thermostatId, command)
 
+    def driverValues(self):
+      names = self.drivers.keys() if isinstance(self.drivers,dict) else [d['driver'] for d in self.drivers]
+      return { name: self.get_driver(name) for name in names }
+
+    def queueWrite(self,name,apply,add,*args):
+      """
+      Queue a write with add(*args,callback) and call apply to set the drivers
+      to what they will be once it's done, so the command can return right away.
+      If the write fails the drivers apply changed are put back, unless
+      something else changed them since.
+      """
+      # Check back soon to see what it did
+      self.controller.poller.command(self.thermostatId)
+      with self.lock:
+        before = self.driverValues()
+        apply()
+        after = self.driverValues()
+      changed = { d: (before[d], after[d]) for d in after if before.get(d) != after[d] }
+      def done(res):
+        if res:
+          if self.write_notice:
+            self.write_notice = False
+            self.controller.removeNotice('write_{}'.format(self.address))
+          # Get what the thermostat really did
+          self.controller.reconcile(self.thermostatId)
+          return
+        self.l_error(name,'Post failed, restoring {}',changed)
+        with self.lock:
+          for driver, (old, new) in changed.items():
+            if self.driver.get(driver) == new:
+              self.set_driver(driver,old)
+        self.write_notice = True
+        self.controller.addNotice({'write_{}'.format(self.address): "{}: {} was not accepted by Ecobee, see the log for details".format(self.name,name)})
+      add(*args,done)
+      return True
+
     def pushResume(self):
       LOGGER.debug('{}:setResume: Cancelling hold'.format(self.address))
-      func = {
-        'type': 'resumeProgram',
-        'params': {
-          'resumeAll': False
-        }
-      }
-      if self.ecobeePost( {'functions': [func]}):
+      def apply():
         # All cancelled, restore settings to program
         self.setScheduleMode(0)
         # This is what the current climate type says it should be
         self.setClimateSettings()
         self.events = list()
-        return True
-      LOGGER.error('{}:setResume: Post failed?'.format(self.address))
-      return False
+      return self.queueWrite('pushResume',apply,self.writes.add_resume)
 
     def setClimateSettings(self,climateName=None):
       if climateName is None:
@@ -359,6 +487,9 @@ class Thermostat(Node):
       # Set to what the current schedule says
       self.setClimateType(climateName)
       cdict = self.getClimateDict(climateName)
+      # Not in the program, like vacation, so the next refresh will have the settings.
+      if cdict is None:
+          return
       self.setCool(cdict['coolTemp'],True)
       self.setHeat(cdict['heatTemp'],True)
       # TODO: cdict contains coolFan & heatFan, should we use those?
@@ -366,6 +497,13 @@ class Thermostat(Node):
       # We assume fan goes off, next refresh will say what it really is.
       self.setFanState(0)
 
+    # The current setpoints, for a setHold that only changes some of them.
+    def holdDefaults(self):
+      return {
+        'heatHoldTemp': self.tempToEcobee(self.get_driver('CLISPH')),
+        'coolHoldTemp': self.tempToEcobee(self.get_driver('CLISPC')),
+      }
+
     def pushScheduleMode(self,clismd=None,coolTemp=None,heatTemp=None,fanMode=None):
       LOGGER.debug("pushScheduleMode: clismd={} coolTemp={} heatTemp={}".format(clismd,coolTemp,heatTemp))
       if clismd is None:
@@ -374,64 +512,45 @@ class Thermostat(Node):
         return self.pushResume()
       # Get the new schedule mode, current if in a hold, or hold next
       clismd_name = self.getHoldType(clismd)
-      if heatTemp is None:
-          heatTemp = self.get_driver('CLISPH')
-      if coolTemp is None:
-          coolTemp = self.get_driver('CLISPC')
-      params = {
-        'holdType': clismd_name,
-        'heatHoldTemp': self.tempToEcobee(heatTemp),
-        'coolHoldTemp': self.tempToEcobee(coolTemp),
-      }
+      # Setpoints that aren't passed are filled in when the hold is sent.
+      params = { 'holdType': clismd_name }
+      if heatTemp is not None:
+          params['heatHoldTemp'] = self.tempToEcobee(heatTemp)
+      if coolTemp is not None:
+          params['coolHoldTemp'] = self.tempToEcobee(coolTemp)
       if fanMode is not None:
           params['fan'] = getMapName(fanMap,fanMode)
-      func = {
-        'type': 'setHold',
-        'params': params
-      }
-      if self.ecobeePost({'functions': [func]}):
+      def apply():
         self.setScheduleMode(clismd_name)
-        self.setCool(coolTemp)
-        self.setHeat(heatTemp)
+        if coolTemp is not None:
+          self.setCool(coolTemp)
+        if heatTemp is not None:
+          self.setHeat(heatTemp)
         if fanMode is not None:
           ir = self.setFanMode(fanMode)
           if int(ir) == 1:
             self.setFanState(1)
           else:
             self.setFanState(0)
+      return self.queueWrite('pushScheduleMode',apply,self.writes.add_hold,params)
+
+    def pushSettings(self,settings,apply):
+      """
+      Queue thermostat settings to be sent, along with any others sent close
+      together.  apply sets the drivers to match, see queueWrite.
+      """
+      return self.queueWrite('pushSettings {}'.format(list(settings)),apply,self.writes.add_settings,settings)
 
     def pushBacklight(self,val):
-        self.l_debug('pushBacklight','{}'.format(val))
-        #
-        # Push settings test
-        #
-        params = {
-            "thermostat": {
-                "settings": {
-                    "backlightOnIntensity":val
-                    }
-                }
-        }
-        if self.ecobeePost(params):
-            self.setBacklight(val)
+        self.l_debug('pushBacklight','{}',val)
+        self.pushSettings({ 'backlightOnIntensity': val },lambda: self.setBacklight(val))
 
     def setBacklight(self,val):
       self.set_driver('GV10', val)
 
     def pushBacklightSleep(self,val):
-        self.l_debug('pushBacklightSleep','{}'.format(val))
-        #
-        # Push settings test
-        #
-        params = {
-            "thermostat": {
-                "settings": {
-                'backlightSleepIntensity':val
-                    }
-                }
-        }
-        if self.ecobeePost(params):
-            self.setBacklightSleep(val)
+        self.l_debug('pushBacklightSleep','{}',val)
+        self.pushSettings({ 'backlightSleepIntensity': val },lambda: self.setBacklightSleep(val))
 
     def setBacklightSleep(self,val):
       self.set_driver('GV11', val)
@@ -458,10 +577,10 @@ class Thermostat(Node):
       if val is True:
         val = self.program['currentClimateRef']
       if not is_int(val):
-        if val in climateMap:
-          val = climateMap[val]
-        else:
-          LOGGER.error("Unknown climate name {}".format(val))
+        name = val
+        val = self.climates.index_of(name)
+        if val is None:
+          LOGGER.error("Unknown climate name {}".format(name))
           return False
       self.set_driver('GV3',int(val))
 
@@ -496,12 +615,12 @@ class Thermostat(Node):
 
     def setCool(self,val,fromE=False,FtoInt=True):
       dval = self.tempToDriver(val,fromE,FtoInt)
-      LOGGER.debug('{}:setCool: {}={} fromE={} FtoInt={}'.format(self.address,val,dval,fromE,FtoInt))
+      LOGGER.debug('%s:setCool: %s=%s fromE=%s FtoInt=%s',self.address,val,dval,fromE,FtoInt)
       self.set_driver('CLISPC',dval)
 
     def setHeat(self,val,fromE=False,FtoInt=True):
       dval = self.tempToDriver(val,fromE,FtoInt)
-      LOGGER.debug('{}:setHeat: {}={} fromE={} FtoInt={}'.format(self.address,val,dval,fromE,FtoInt))
+      LOGGER.debug('%s:setHeat: %s=%s fromE=%s FtoInt=%s',self.address,val,dval,fromE,FtoInt)
       self.set_driver('CLISPH',dval)
 
     def setFanMode(self,val):
@@ -557,70 +676,45 @@ class Thermostat(Node):
       else:
         name = getMapName(modeMap,int(cmd['value']))
         LOGGER.info('Setting Thermostat {} to mode: {} (value={})'.format(self.name, name, cmd['value']))
-        if self.ecobeePost( {'thermostat': {'settings': {'hvacMode': name}}}):
-          self.set_driver(cmd['cmd'], cmd['value'])
+        self.pushSettings({'hvacMode': name},lambda: self.set_driver(cmd['cmd'], cmd['value']))
 
     def cmdSetClimateType(self, cmd):
       LOGGER.debug('{}:cmdSetClimateType: {}={}'.format(self.address,cmd['cmd'],cmd['value']))
       # We don't check if this is already current since they may just want setpoints returned.
-      climateName = getMapName(climateMap,int(cmd['value']))
-      command = {
-        'functions': [{
-          'type': 'setHold',
-          'params': {
-            'holdType': self.getHoldType(),
-            'holdClimateRef': climateName
-          }
-        }]
+      climateName = self.climates.ref(cmd['value'])
+      if climateName is None:
+        self.l_error('cmdSetClimateType','Unknown climate index {}'.format(cmd['value']))
+        return
+      holdType = self.getHoldType()
+      params = {
+        'holdType': holdType,
+        'holdClimateRef': climateName
       }
-      if self.ecobeePost(command):
+      def apply():
         self.set_driver(cmd['cmd'], cmd['value'])
-        self.set_driver('CLISMD',transitionMap[self.getHoldType()])
+        self.set_driver('CLISMD',transitionMap[holdType])
         # If we went back to current climate name that will reset temps, so reset isy
         #if self.program['currentClimateRef'] == climateName:
         self.setClimateSettings(climateName)
+      self.queueWrite('cmdSetClimateType',apply,self.writes.add_hold,params)
 
     def cmdSetFanOnTime(self, cmd):
       if int(self.get_driver(cmd['cmd'])) == int(cmd['value']):
         LOGGER.debug("cmdSetFanOnTime: {} already set to {}".format(cmd['cmd'],int(cmd['value'])))
       else:
-        command = {
-          'thermostat': {
-            'settings': {
-              'fanMinOnTime': cmd['value']
-            }
-          }
-        }
-        if self.ecobeePost( command):
-          self.set_driver(cmd['cmd'], cmd['value'])
+        self.pushSettings({'fanMinOnTime': cmd['value']},lambda: self.set_driver(cmd['cmd'], cmd['value']))
 
     def cmdSmartHome(self, cmd):
       if int(self.get_driver(cmd['cmd'])) == int(cmd['value']):
         LOGGER.debug("cmdSetSmartHome: {} already set to {}".format(cmd['cmd'],int(cmd['value'])))
       else:
-        command = {
-          'thermostat': {
-            'settings': {
-              'autoAway': True if cmd['value'] == '1' else False
-            }
-          }
-        }
-        if self.ecobeePost( command):
-          self.set_driver(cmd['cmd'], cmd['value'])
+        self.pushSettings({'autoAway': True if cmd['value'] == '1' else False},lambda: self.set_driver(cmd['cmd'], cmd['value']))
 
     def cmdFollowMe(self, cmd):
       if int(self.get_driver(cmd['cmd'])) == int(cmd['value']):
         LOGGER.debug("cmdFollowMe: {} already set to {}".format(cmd['cmd'],int(cmd['value'])))
       else:
-        command = {
-          'thermostat': {
-            'settings': {
-              'followMeComfort': True if cmd['value'] == '1' else False
-            }
-          }
-        }
-        if self.ecobeePost( command):
-          self.set_driver(cmd['cmd'], cmd['value'])
+        self.pushSettings({'followMeComfort': True if cmd['value'] == '1' else False},lambda: self.set_driver(cmd['cmd'], cmd['value']))
 
     def cmdSetDoWeather(self, cmd):
       value = int(cmd['value'])
@@ -661,65 +755,44 @@ class Thermostat(Node):
         newTemp = coolTemp
       LOGGER.debug('{} {} {} {}'.format(cmdtype, driver, self.get_driver(driver), newTemp))
       #LOGGER.info('Setting {} {} Set Point to {}{}'.format(self.name, cmdtype, cmd['value'], 'C' if self.useCelsius else 'F'))
-      if self.ecobeePost(
-        {
-          "functions": [
-            {
-              "type":"setHold",
-              "params": {
-                "holdType":  self.getHoldType(),
-                "heatHoldTemp":self.tempToEcobee(heatTemp),
-                "coolHoldTemp":self.tempToEcobee(coolTemp),
-              }
-            }
-          ]
-        }):
+      holdType = self.getHoldType()
+      # Only the setpoint we changed, the other is filled in when the hold is sent.
+      params = { "holdType": holdType }
+      params['heatHoldTemp' if cmdtype == 'heatTemp' else 'coolHoldTemp'] = self.tempToEcobee(newTemp)
+      def apply():
         self.set_driver(driver, newTemp)
-        self.set_driver('CLISMD',transitionMap[self.getHoldType()])
+        self.set_driver('CLISMD',transitionMap[holdType])
+      self.queueWrite('setPoint',apply,self.writes.add_hold,params)
 
     def cmdSetHumidity(self, cmd):
       if int(self.get_driver(cmd['cmd'])) == int(cmd['value']):
         LOGGER.debug(f"cmdSetHumidity: {cmd['cmd']} already set to {cmd['value']}")
         return
 
-      command = {
-        'thermostat': {
-          'settings': {
-            'humidity': cmd["value"]
-          }
-        }
-      }
-
-      if self.ecobeePost(command):
-        self.set_driver(cmd['cmd'], cmd['value'])
+      self.pushSettings({'humidity': cmd["value"]},lambda: self.set_driver(cmd['cmd'], cmd['value']))
 
     def cmdSetDehumidity(self, cmd):
       if int(self.get_driver(cmd['cmd'])) == int(cmd['value']):
         LOGGER.debug(f"cmdSetDehumidity: {cmd['cmd']} already set to {cmd['value']}")
         return 
 
-      command = {
-        'thermostat': {
-          'settings': {
-            'dehumidifierLevel': cmd['value']
-          }
-        }
-      }
-      
-      if self.ecobeePost(command):
-        self.set_driver(cmd['cmd'], cmd['value'])
+      self.pushSettings({'dehumidifierLevel': cmd['value']},lambda: self.set_driver(cmd['cmd'], cmd['value']))
 
-    def l_info(self, name, string):
-        LOGGER.info("%s:%s:%s: %s" %  (self.id,self.name,name,string))
+    # string is only formatted with args if the level is enabled.
+    def l_info(self, name, string, *args):
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info("%s:%s:%s: %s" %  (self.id,self.name,name,string.format(*args) if args else string))
 
-    def l_error(self, name, string):
-        LOGGER.error("%s:%s:%s: %s" % (self.id,self.name,name,string))
+    def l_error(self, name, string, *args):
+        LOGGER.error("%s:%s:%s: %s" % (self.id,self.name,name,string.format(*args) if args else string))
 
-    def l_warning(self, name, string):
-        LOGGER.warning("%s:%s:%s: %s" % (self.id,self.name,name,string))
+    def l_warning(self, name, string, *args):
+        if LOGGER.isEnabledFor(logging.WARNING):
+            LOGGER.warning("%s:%s:%s: %s" % (self.id,self.name,name,string.format(*args) if args else string))
 
-    def l_debug(self, name, string):
-        LOGGER.debug("%s:%s:%s:%s: %s" % (self.id,self.address,self.name,name,string))
+    def l_debug(self, name, string, *args):
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("%s:%s:%s:%s: %s" % (self.id,self.address,self.name,name,string.format(*args) if args else string))
 
     hint = '0x010c0100'
     commands = { 'QUERY': query,
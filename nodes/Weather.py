@@ -8,8 +8,12 @@ except ImportError:
 from copy import deepcopy
 from const import driversMap,windMap
 from node_funcs import *
+from pgLog import getLogger
+from driverCache import driverCache
 
-class Weather(Node):
+LOGGER = getLogger(LOGGER,'Weather')
+
+class Weather(driverCache,Node):
     def __init__(self, controller, primary, address, name, useCelsius, forecast):
         super().__init__(controller, primary, address, name)
         self.type = 'forecast' if forecast else 'weather'
@@ -53,7 +57,7 @@ class Weather(Node):
         'GV9': currentWeather['weatherSymbol']
       }
       for key, value in updates.items():
-        self.setDriver(key, value)
+        self.set_driver(key, value)
 
     def query(self, command=None):
         self.reportDrivers()
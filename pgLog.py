@@ -0,0 +1,55 @@
+"""
+Logging helpers shared by the nodes and pgSession.
+
+Each subsystem logs to its own child of the polyinterface LOGGER so the
+levels can be set separately, and messages are only built when the level is
+enabled.  Pass arguments instead of formatting the string yourself:
+
+    LOGGER.debug("%s:update: sensor=%s", self.address, sensor)
+    self.l_debug('_update', 'runtime={}', lazyJson(self.runtime))
+"""
+
+import json
+import logging
+from collections.abc import Mapping
+
+# Subsystems with their own logger, see set_levels.
+subsystems = ('Controller','Thermostat','Sensor','Weather','pgSession')
+
+def getLogger(logger,subsystem):
+    return logger.getChild(subsystem)
+
+def set_levels(logger,level,session_level=None):
+    """
+    Set the level for all the subsystems.  session_level allows pgSession to be
+    different, since it's very verbose in debug.
+    """
+    logger.setLevel(level)
+    for subsystem in subsystems:
+        getLogger(logger,subsystem).setLevel(level)
+    if session_level is not None:
+        getLogger(logger,'pgSession').setLevel(session_level)
+
+class lazyJson():
+    """
+    Pretty prints obj as json, but only when it's actually logged.
+    """
+    __slots__ = ('obj',)
+
+    def __init__(self,obj):
+        self.obj = obj
+
+    @staticmethod
+    def _default(obj):
+        # The thermostatState projections and customDataStore views
+        if hasattr(obj,'as_dict'):
+            return obj.as_dict()
+        if isinstance(obj,Mapping):
+            return dict(obj)
+        return str(obj)
+
+    def __str__(self):
+        try:
+            return json.dumps(self.obj,sort_keys=True,indent=2,default=self._default)
+        except (TypeError,ValueError):
+            return str(self.obj)
@@ -2,75 +2,287 @@
 Work on makeing this a generic session handler for all Polyglot's
 """
 
-import requests,json,warnings
-from requests.adapters import HTTPAdapter, Retry
+import requests,json,warnings,time,logging
+import threading,collections,contextlib
+import concurrent.futures
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError,ConnectTimeoutError
 
 class pgSession():
 
-    def __init__(self,parent,l_name,logger,host,port=None,debug_level=-1):
+    # pool_size is the number of connections kept to the host, and
+    # max_workers is the number of requests get_many, post_many and submit run at once.
+    # budget is the total seconds one request, including retries, may take.
+    # breaker is an optional circuitBreaker all requests go through.
+    def __init__(self,parent,l_name,logger,host,port=None,debug_level=-1,pool_size=10,max_workers=4,budget=None,breaker=None):
         self.parent = parent
         self.l_name = l_name
         self.logger = logger
         self.host   = host
         self.port   = port
         self.debug_level = debug_level
+        self.max_workers = max(1,max_workers)
+        # Need at least one connection per worker so they don't wait on each other.
+        self.pool_size   = max(pool_size,self.max_workers)
+        self.executor    = None
+        self.lock        = threading.Lock()
+        if budget is not None:
+            self.budget = budget
+        self.breaker = breaker
         if port is None:
             self.port_s = ""
         else:
             self.port_s = ':{}'.format(port)
         # Create our session
         self.session = requests.Session()
-        # Allow for retries on all connections.
-        retries = 30
-        backoff_factor = .3
-        status_force_list = (500, 502, 503, 504, 505, 506)
+        # We handle retries ourselves so they fit inside the deadline,
+        # see _send.
         adapter = HTTPAdapter(
-                    max_retries=Retry(
-                        total=retries,
-                        read=retries,
-                        connect=retries,
-                        backoff_factor=backoff_factor,
-                        status_forcelist=status_force_list,
-                    )
+                    max_retries=0,
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size
                 )
         for prefix in "http://", "https://":
             self.session.mount(prefix, adapter)
+        # Latency of recent good requests, used to pick the timeouts.
+        self.latency = collections.deque(maxlen=100)
+        self.tlocal  = threading.local()
+        # Requests are made from many threads, so the counts need a lock.
+        self.stats_lock = threading.Lock()
+        self.stats   = { 'requests': 0, 'retries': 0, 'connection_errors': 0, 'deadline_errors': 0, 'rejected': 0 }
+
+    # Total seconds a single request, including all retries, may take.
+    budget = 120
+    backoff_factor = .3
+    backoff_max = 30
+    status_force_list = (500, 502, 503, 504, 505, 506)
+    # Timeouts used until we have enough latency samples.
+    connect_timeout = 61
+    read_timeout    = 10
+
+    def timeouts(self):
+        """
+        Return the (connect, read) timeouts based on the observed latency.
+        Read is 3 times the 95th percentile and connect is 3 times the median,
+        within sensible limits.
+        """
+        samples = sorted(self.latency)
+        if len(samples) < 10:
+            return (self.connect_timeout,self.read_timeout)
+        p50 = samples[len(samples)//2]
+        p95 = samples[min(len(samples)-1,int(len(samples)*.95))]
+        return (min(max(p50*3,3.05),self.connect_timeout),min(max(p95*3,5),60))
+
+    @contextlib.contextmanager
+    def deadline(self,ts):
+        """
+        All requests made by this thread inside the with block must finish
+        by time ts (as returned by time.time()).  Can be nested, the earliest
+        deadline wins.
+        """
+        prev = getattr(self.tlocal,'deadline',None)
+        self.tlocal.deadline = ts if prev is None else min(ts,prev)
+        try:
+            yield
+        finally:
+            self.tlocal.deadline = prev
+
+    def current_deadline(self):
+        return getattr(self.tlocal,'deadline',None)
+
+    def count(self,stat):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def not_sent(self,err):
+        """
+        True if the ConnectionError err happened before the request was
+        sent, so it's safe to send again.
+        """
+        if isinstance(err,requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(err.args[0],'reason',None) if len(err.args) > 0 else None
+        return isinstance(reason,(NewConnectionError,ConnectTimeoutError))
+
+    def last_error(self):
+        """
+        Why the last request in this thread failed: 'connection', 'deadline',
+        'open' when the circuit breaker would not allow it, or None if it didn't.
+        """
+        return getattr(self.tlocal,'error',None)
+
+    def _send(self,name,method,url,**kwargs):
+        """
+        Send the request, retrying connection errors, timeouts and server
+        errors with backoff until it works or the deadline is hit.  Posts are
+        only retried when they could not have been sent, not on read timeouts,
+        dropped connections or server errors since they may have been applied.
+        Returns the response, or False on failure.
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            self.tlocal.error = 'open'
+            self.count('rejected')
+            self.l_debug(name,0,"Circuit open, not sending {}",url)
+            return False
+        try:
+            response = self._retry(name,method,url,**kwargs)
+        except Exception:
+            # Always let the breaker know, this may have been its half open test.
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise
+        if self.breaker is not None:
+            if response is False or response.status_code in self.status_force_list:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+        return response
+
+    def _retry(self,name,method,url,**kwargs):
+        start = time.time()
+        deadline = start + self.budget
+        if self.current_deadline() is not None:
+            deadline = min(deadline,self.current_deadline())
+        retry_all = method != 'POST'
+        attempt = 0
+        response = None
+        self.count('requests')
+        self.tlocal.error = None
+        while True:
+            attempt += 1
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            (connect,read) = self.timeouts()
+            try:
+                t0 = time.time()
+                response = self.session.request(method,url,
+                    timeout=(min(connect,remaining),min(read,remaining)),**kwargs)
+                elapsed = time.time() - t0
+            except requests.exceptions.ReadTimeout as e:
+                # The request was sent, so only retry if it's safe to send again.
+                if not retry_all:
+                    self.tlocal.error = 'connection'
+                    self.count('connection_errors')
+                    self.l_error(name,"Read timeout for %s: %s" % (url, e))
+                    return False
+                self.l_debug(name,0,"try {} for {} failed: {}",attempt,url,e)
+                response = None
+            except requests.exceptions.ConnectionError as e:
+                # The connection may have dropped after it was sent.
+                if not (retry_all or self.not_sent(e)):
+                    self.tlocal.error = 'connection'
+                    self.count('connection_errors')
+                    self.l_error(name,"Connection error after sending %s: %s" % (url, e))
+                    return False
+                self.l_debug(name,0,"try {} for {} failed: {}",attempt,url,e)
+                response = None
+            # This is supposed to catch all request excpetions.
+            except requests.exceptions.RequestException as e:
+                self.tlocal.error = 'connection'
+                self.count('connection_errors')
+                self.l_error(name,"Connection error for %s: %s" % (url, e))
+                return False
+            else:
+                if not (retry_all and response.status_code in self.status_force_list):
+                    self.latency.append(elapsed)
+                    return response
+                self.l_debug(name,0,"try {} for {} returned {}",attempt,url,response.status_code)
+            sleep = min(self.backoff_factor * (2 ** (attempt - 1)),self.backoff_max)
+            if time.time() + sleep >= deadline:
+                break
+            self.count('retries')
+            time.sleep(sleep)
+        if response is not None:
+            # Ran out of time retrying a server error, let them see what it was.
+            return response
+        self.tlocal.error = 'deadline'
+        self.count('deadline_errors')
+        self.l_error(name,"Deadline exceeded for %s after %d tries in %.1f seconds" % (url,attempt,time.time()-start))
+        return False
 
     def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
         self.session.close()
         return
 
+    def get_many(self,reqs):
+        """
+        Run a list of get requests concurrently.  Each entry is a dict of
+        the keyword arguments for get, e.g. {'path': 'x', 'payload': {}}.
+        Returns a list of results in the same order as reqs, each is what get
+        would return.  A request that failed has code error_code and error is
+        what last_error() said, or 'exception' if it raised one.
+        """
+        return self._many(self.get,reqs)
+
+    def post_many(self,reqs):
+        """
+        Same as get_many, but for post.
+        """
+        return self._many(self.post,reqs)
+
+    # The code returned by get_many and post_many for a request that raised an exception.
+    error_code = -1
+
+    def _executor(self):
+        # Return our own reference so close() can't take it away before it's used.
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            return self.executor
+
+    def submit(self,func,*args,**kwargs):
+        """
+        Run func on the same workers get_many and post_many use, returns the
+        future.
+        """
+        return self._executor().submit(func,*args,**kwargs)
+
+    def _many(self,func,reqs):
+        def run(req):
+            res = func(**req)
+            if res is False:
+                # last_error is only known in the thread that made the request.
+                return { 'code': self.error_code, 'data': False, 'error': self.last_error() }
+            return res
+        executor = self._executor()
+        futures = [executor.submit(run,req) for req in reqs]
+        results = list()
+        for i, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                self.l_error('many',"Request {} failed: {}".format(reqs[i],e), exc_info=True)
+                results.append({ 'code': self.error_code, 'data': False, 'error': 'exception' })
+        return results
+
     def get(self,path,payload,auth=None):
         url = "https://{}{}/{}".format(self.host,self.port_s,path)
-        self.l_debug('get',0,"Sending: url={0} payload={1}".format(url,payload))
+        self.l_debug('get',0,"Sending: url={0} payload={1}",url,payload)
         # No speical headers?
         headers = {
             "Content-Type": "application/json"
         }
         if auth is not None:
             headers['Authorization'] = auth
-        self.l_debug('get', 1, "headers={}".format(headers))
+        self.l_debug('get', 1, "headers={}",headers)
         # Some are getting unclosed socket warnings due to garbage collection?? no idea why, so just ignore them since we dont' care
         warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<socket.socket.*>")
         #self.session.headers.update(headers)
-        try:
-            response = self.session.get(
-                url,
-                params=payload,
-                headers=headers,
-                timeout=(61,10)
-            )
-            self.l_debug('get', 1, "url={}".format(response.url))
-        # This is supposed to catch all request excpetions.
-        except requests.exceptions.RequestException as e:
-            self.l_error('get',"Connection error for %s: %s" % (url, e))
+        response = self._send('get','GET',url,params=payload,headers=headers)
+        if response is False:
             return False
+        self.l_debug('get', 1, "url={}",response.url)
         return(self.response(response,'get'))
 
     def response(self,response,name):
         fname = 'reponse:'+name
-        self.l_debug(fname,0,' Got: code=%s' % (response.status_code))
-        self.l_debug(fname,2,'      text=%s' % (response.text))
+        self.l_debug(fname,0,' Got: code={}',response.status_code)
+        self.l_debug(fname,2,'      text={}',response.text)
         json_data = False
         st = False
         if response.status_code == 200:
@@ -104,7 +316,7 @@ class pgSession():
         url = "https://{}{}/{}".format(self.host,self.port_s,path)
         if dump:
             payload = json.dumps(payload)
-        self.l_debug('post',0,"Sending: url={0} payload={1}".format(url,payload))
+        self.l_debug('post',0,"Sending: url={0} payload={1}",url,payload)
         headers = {
             'Content-Length': str(len(payload))
         }
@@ -112,50 +324,34 @@ class pgSession():
             headers['Content-Type'] = 'application/json'
         if auth is not None:
             headers['Authorization'] = auth
-        self.l_debug('post', 1, "headers={}".format(headers))
+        self.l_debug('post', 1, "headers={}",headers)
         #self.session.headers.update(headers)
         # Some are getting unclosed socket warnings due to garbage collection?? no idea why, so just ignore them since we dont' care
         warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<socket.socket.*>")
-        try:
-            response = self.session.post(
-                url,
-                params=params,
-                data=payload,
-                headers=headers,
-                timeout=(61,10)
-            )
-            self.l_debug('post', 1, "url={}".format(response.url))
-        # This is supposed to catch all request excpetions.
-        except requests.exceptions.RequestException as e:
-            self.l_error('post',"Connection error for %s: %s" % (url, e))
+        response = self._send('post','POST',url,params=params,data=payload,headers=headers)
+        if response is False:
             return False
+        self.l_debug('post', 1, "url={}",response.url)
         return(self.response(response,'post'))
 
     def delete(self,path,auth=None):
         url = "https://{}{}/{}".format(self.host,self.port_s,path)
-        self.l_debug('delete',0,"Sending: url={0}".format(url))
+        self.l_debug('delete',0,"Sending: url={0}",url)
         # No speical headers?
         headers = {
             "Content-Type": "application/json"
         }
         if auth is not None:
             headers['Authorization'] = auth
-        self.l_debug('delete', 1, "headers={}".format(headers))
+        self.l_debug('delete', 1, "headers={}",headers)
         # Some are getting unclosed socket warnings due to garbage collection?? no idea why, so just ignore them since we dont' care
         warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<socket.socket.*>")
         #self.session.headers.update(headers)
-        try:
-            response = self.session.delete(
-                url,
-                headers=headers,
-                timeout=(61,10)
-            )
-            self.l_debug('delete', 1, "url={}".format(response.url))
-            self.logger.debug('delete got: {}'.format(response))
-        # This is supposed to catch all request excpetions.
-        except requests.exceptions.RequestException as e:
-            self.l_error('delete',"Connection error for %s: %s" % (url, e))
+        response = self._send('delete','DELETE',url,headers=headers)
+        if response is False:
             return False
+        self.l_debug('delete', 1, "url={}",response.url)
+        self.l_debug('delete', 0, 'delete got: {}',response)
         return(self.response(response,'delete'))
 
 
@@ -169,6 +365,7 @@ class pgSession():
     def l_warning(self, name, string):
         self.logger.warning("%s:%s: %s" % (self.l_name,name,string))
 
-    def l_debug(self, name, debug_level, string):
-        if self.debug_level >= debug_level:
-            self.logger.debug("%s:%s: %s" % (self.l_name,name,string))
+    # string is only formatted with args if the level is enabled.
+    def l_debug(self, name, debug_level, string, *args):
+        if self.debug_level >= debug_level and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s:%s: %s" % (self.l_name,name,string.format(*args) if args else string))
@@ -0,0 +1,127 @@
+"""
+Decide when each thermostat should be checked for changes next.
+
+Each check picks the interval from what the thermostat is doing:
+
+  active:       A command was just sent or a hold is about to end, use
+                min_interval.
+  running:      Equipment is running, use twice min_interval.
+  idle:         Start at idle_interval and double it each time nothing
+                changed, up to max_interval.  Overnight this means very few
+                requests.
+  disconnected: The Ecobee servers can't see it, use max_interval.
+
+All requests made while polling are counted and no more than budget are
+made in an hour.  When the budget is used up checks wait until there is room.
+"""
+
+import time,threading
+from collections import deque
+
+class pollScheduler():
+
+    # How long after a command, or before a hold ends, the thermostat is active.
+    active_time = 300
+
+    def __init__(self,logger,min_interval=30,idle_interval=180,max_interval=900,budget=600):
+        self.logger        = logger
+        self.min_interval  = min_interval
+        self.idle_interval = max(idle_interval,min_interval)
+        self.max_interval  = max(max_interval,self.idle_interval)
+        # Maximum number of requests in an hour
+        self.budget        = budget
+        self.lock          = threading.Lock()
+        # Times of the requests in the last hour
+        self.requests      = deque()
+        # Per thermostat: next check time, interval and time of the last command
+        self.data          = dict()
+        self.budget_warned = False
+
+    def _get(self,thermostatId):
+        if not thermostatId in self.data:
+            self.data[thermostatId] = { 'next': 0, 'interval': self.min_interval, 'command': 0 }
+        return self.data[thermostatId]
+
+    def due(self,ids,now=None):
+        """
+        The thermostat ids from ids that should be checked now.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return [tid for tid in ids if self._get(tid)['next'] <= now]
+
+    def command(self,thermostatId):
+        """
+        A command was sent, so check it again soon.
+        """
+        with self.lock:
+            data = self._get(thermostatId)
+            data['command']  = time.time()
+            data['interval'] = self.min_interval
+            data['next']     = min(data['next'],time.time() + self.min_interval)
+
+    def checked(self,thermostatId,changed,connected=True,running=False,hold_remaining=None):
+        """
+        thermostatId was checked, set when it's checked next based on its
+        state.  changed is True if any revisions changed.
+        Returns the new interval in seconds.
+        """
+        now = time.time()
+        with self.lock:
+            data = self._get(thermostatId)
+            if not connected:
+                interval = self.max_interval
+            elif now - data['command'] < self.active_time or (hold_remaining is not None and hold_remaining < self.active_time):
+                interval = self.min_interval
+            elif running:
+                interval = self.min_interval * 2
+            elif changed or data['interval'] < self.idle_interval:
+                interval = self.idle_interval
+            else:
+                interval = min(data['interval'] * 2,self.max_interval)
+            data['interval'] = interval
+            data['next']     = now + interval
+            return interval
+
+    def interval(self,thermostatId):
+        with self.lock:
+            return self._get(thermostatId)['interval']
+
+    def remove(self,thermostatId):
+        with self.lock:
+            self.data.pop(thermostatId,None)
+
+    def _expire(self,now):
+        while len(self.requests) > 0 and self.requests[0] <= now - 3600:
+            self.requests.popleft()
+
+    def allow(self,count=1):
+        """
+        True if count more requests fit in the budget for the last hour.
+        """
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            if len(self.requests) + count <= self.budget:
+                self.budget_warned = False
+                return True
+            if not self.budget_warned:
+                self.budget_warned = True
+                self.logger.warning("pollScheduler: {} requests made in the last hour, waiting to stay within the budget of {}".format(len(self.requests),self.budget))
+            return False
+
+    def spend(self,count=1):
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            for i in range(count):
+                self.requests.append(now)
+
+    def used(self):
+        """
+        Number of requests made in the last hour.
+        """
+        with self.lock:
+            self._expire(time.time())
+            return len(self.requests)
@@ -0,0 +1,142 @@
+"""
+Build the custom profile files for the thermostat climate types.
+
+The templates are read and compiled once, so building a profile is only
+joining strings.  Thermostats with the same climate type names share one
+nodedef, editor and NLS set, named by a fingerprint of the names, so the
+profile only grows with the number of different climate lists.
+
+The profile is built in memory and hashed, along with the static profile
+files, so it's only written and installed when it's different from what
+was installed last time.
+"""
+
+import os,re,hashlib
+from node_funcs import make_file_dir
+
+class profileBuilder():
+
+    nls_template     = 'template/en_us.txt'
+    nodedef_template = 'template/thermostat.xml'
+    editor_template  = 'template/editors.xml'
+    nls_file         = 'profile/nls/en_us.txt'
+    nodedef_file     = 'profile/nodedef/custom.xml'
+    editor_file      = 'profile/editor/custom.xml'
+    # Installed with the custom files, so a change to them needs an install too.
+    static_files     = ('profile/version.txt','profile/nodedef/nodedefs.xml','profile/editor/editors.xml')
+    # Longest first, since tstatcnt is the start of tstatcnta
+    placeholders     = ('tstatcnta','tstatcnt','tstatid')
+
+    def __init__(self,logger,climateList):
+        self.logger      = logger
+        self.climateList = climateList
+        with open(self.nls_template) as f:
+            self.nls_head = f.read()
+        self.nodedef = self.compile(self.nodedef_template)
+        self.editor  = self.compile(self.editor_template)
+
+    def compile(self,file_name):
+        """
+        Return a function that renders the template file_name with a dict
+        of placeholder values.
+        """
+        with open(file_name) as f:
+            parts = re.split('({})'.format('|'.join(self.placeholders)),f.read())
+        # Every odd part is a placeholder
+        def render(values):
+            return ''.join([values[part] if i % 2 else part for i, part in enumerate(parts)])
+        return render
+
+    def fingerprint(self,climates):
+        """
+        The id of the shared nodedef for a thermostat with the climateRegistry climates.
+        """
+        return hashlib.sha1('\n'.join(climates.names()).encode()).hexdigest()[:10]
+
+    def profile_ids(self,climates):
+        """
+        The shared nodedef id for each thermostat in the thermostatId to
+        climateRegistry dict.
+        """
+        return { id: self.fingerprint(climates[id]) for id in climates }
+
+    def render(self,climates):
+        """
+        Build the profile files for the thermostatId to climateRegistry dict.
+        Returns a dict of file name to contents.
+        """
+        nodedefs = ['<nodedefs>\n']
+        editors  = ['<editors>\n']
+        nls      = [self.nls_head]
+        # One set for each different list of names
+        groups = dict()
+        for id in climates:
+            fp = self.fingerprint(climates[id])
+            if not fp in groups:
+                groups[fp] = climates[id]
+        for id in sorted(groups):
+            names = groups[id].names()
+            values = {
+                'tstatid':   str(id),
+                'tstatcnta': str(len(names)-1),
+                # This is minus 5 because we don't allow selecting vacation or smartAway, ...
+                # But not currently using this because we don't have different list for
+                # status and programs?
+                'tstatcnt':  str(len(self.climateList)-5),
+            }
+            nodedefs.append(self.nodedef(values))
+            editors.append(self.editor(values))
+            nls.append("\n")
+            nls.append('ND-EcobeeC_{0}-NAME = Ecobee Thermostat {0} (C)\n'.format(id))
+            nls.append('ND-EcobeeC_{0}-ICON = Thermostat\n'.format(id))
+            nls.append('ND-EcobeeF_{0}-NAME = Ecobee Thermostat {0} (F)\n'.format(id))
+            nls.append('ND-EcobeeF_{0}-ICON = Thermostat\n'.format(id))
+            for i, name in enumerate(names):
+                nls.append("CT_{}-{} = {}\n".format(id,i,name))
+        nodedefs.append('</nodedefs>\n')
+        editors.append('</editors>\n')
+        return {
+            self.nls_file:     ''.join(nls),
+            self.nodedef_file: ''.join(nodedefs),
+            self.editor_file:  ''.join(editors),
+        }
+
+    def hash(self,files):
+        """
+        Hash of the profile files and the static files installed with them.
+        """
+        h = hashlib.sha256()
+        for name in sorted(files):
+            h.update(name.encode())
+            h.update(files[name].encode())
+        for name in self.static_files:
+            h.update(name.encode())
+            try:
+                with open(name,'rb') as f:
+                    h.update(f.read())
+            except OSError as err:
+                self.logger.error('profileBuilder: failed to read {}: {}'.format(name,err))
+        return h.hexdigest()
+
+    def write(self,files):
+        """
+        Write the files that are different from what's on disk.  Each is
+        written to a temp file and moved in place, so a partial file is never
+        installed.  Returns the list of files written.
+        """
+        written = list()
+        for name, data in files.items():
+            try:
+                with open(name) as f:
+                    if f.read() == data:
+                        continue
+            except OSError:
+                pass
+            make_file_dir(name)
+            tmp = name + '.tmp'
+            with open(tmp,'w') as f:
+                f.write(data)
+            os.replace(tmp,name)
+            self.logger.info('profileBuilder: Wrote {}'.format(name))
+            written.append(name)
+        return written
@@ -0,0 +1,153 @@
+"""
+Track the last Ecobee revisions that were applied to each thermostat.
+
+The thermostatSummary returns a set of revision values for each thermostat,
+and the values only change when the matching data on the Ecobee servers
+change.  This remembers what we last applied, per thermostat and per revision
+field, so we only fetch what is new.  It's only kept in memory, since a
+restart has to get all the data to create the nodes anyway.
+
+Each summary entry is kept in a revisionRecord, and comparing revisions
+gives a mask with one bit per revision field.
+"""
+
+import time,threading
+
+# The revision fields from the thermostatSummary revisionList
+rev_fields = ('thermostatRev','alertsRev','runtimeRev','intervalRev')
+# Mask with every revision field set
+rev_all = (1 << len(rev_fields)) - 1
+
+class revisionRecord():
+    """
+    One thermostat from the thermostatSummary revisionList, which is
+      thermostatId:name:connected:thermostatRev:alertsRev:runtimeRev:intervalRev
+    Fields can also be read as record['name'] like the dict it replaces.
+    """
+
+    __slots__ = ('thermostatId','name','connected') + rev_fields
+
+    def __init__(self,thermostatId,name,connected,thermostatRev,alertsRev,runtimeRev,intervalRev):
+        self.thermostatId  = thermostatId
+        self.name          = name
+        self.connected     = connected
+        self.thermostatRev = thermostatRev
+        self.alertsRev     = alertsRev
+        self.runtimeRev    = runtimeRev
+        self.intervalRev   = intervalRev
+
+    def __getitem__(self,key):
+        try:
+            return getattr(self,key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return 'revisionRecord({})'.format(':'.join([getattr(self,f) for f in self.__slots__]))
+
+    @classmethod
+    def parse_list(cls,revisionList):
+        """
+        Parse the revisionList strings into a thermostatId to revisionRecord
+        dict.  Entries that don't have all the fields are skipped.
+        """
+        ret = dict()
+        if not isinstance(revisionList,list):
+            return ret
+        for line in revisionList:
+            parts = line.split(':',6)
+            if len(parts) == 7:
+                ret[parts[0]] = cls(*parts)
+        return ret
+
+    def compare(self,other):
+        """
+        Mask of the revision fields that are different in other, which is a
+        revisionRecord or a dict of the fields.  None is all of them.
+        """
+        if other is None:
+            return rev_all
+        get = other.get if isinstance(other,dict) else other.__getitem__
+        mask = 0
+        bit  = 1
+        for rev in rev_fields:
+            if getattr(self,rev) != get(rev):
+                mask |= bit
+            bit <<= 1
+        return mask
+
+    @staticmethod
+    def names(mask):
+        """
+        The list of revision fields in mask.
+        """
+        return [rev for i, rev in enumerate(rev_fields) if mask & (1 << i)]
+
+class revTracker():
+
+    fields = rev_fields
+
+    def __init__(self,logger):
+        self.logger    = logger
+        self.lock      = threading.Lock()
+        self.data      = dict()
+
+    def changed_mask(self,tstat):
+        """
+        Mask of the revision fields in the revisionRecord tstat that are
+        different from what was last applied.  A thermostat we have never
+        applied is considered to have changed everything.
+        """
+        with self.lock:
+            return tstat.compare(self.data.get(tstat.thermostatId))
+
+    def changed(self,tstat):
+        """
+        Return the list of revision fields in tstat that are different from
+        what was last applied.
+        """
+        return revisionRecord.names(self.changed_mask(tstat))
+
+    def applied(self,tstat,fields=None):
+        """
+        Record the revisions from the summary data tstat as applied.  Only the
+        revision fields passed in are advanced, default is all of them.
+        """
+        if fields is None:
+            fields = self.fields
+        with self.lock:
+            tid = tstat.thermostatId
+            if not tid in self.data:
+                self.data[tid] = dict()
+            cur = self.data[tid]
+            upd = False
+            for rev in fields:
+                if cur.get(rev) != getattr(tstat,rev):
+                    cur[rev] = getattr(tstat,rev)
+                    upd = True
+            if upd:
+                cur['changed'] = time.time()
+            return upd
+
+    def get(self,thermostatId,field):
+        """
+        The last applied value of the revision field for thermostatId, or
+        None if never.
+        """
+        with self.lock:
+            cur = self.data.get(thermostatId)
+            return None if cur is None else cur.get(field)
+
+    def last_changed(self,thermostatId):
+        """
+        Time in seconds since the epoch when thermostatId last had a
+        revision applied, or None if never.
+        """
+        with self.lock:
+            cur = self.data.get(thermostatId)
+            return None if cur is None else cur.get('changed')
+
+    def remove(self,thermostatId):
+        with self.lock:
+            if thermostatId in self.data:
+                del self.data[thermostatId]
@@ -0,0 +1,136 @@
+"""
+Compact thermostat state.
+
+The Ecobee thermostat selection returns much more than the nodes use, and
+each section is projected into a small slotted object with only the fields
+that are used.  Nothing refers to the raw data once it's projected, so it's
+released as soon as the update is done.
+
+Fields are read like the dicts they replace, section['hvacMode'], and a
+field Ecobee didn't send is None.
+"""
+
+class projection():
+
+    __slots__ = ()
+
+    def __init__(self,data=None):
+        if data is None:
+            data = dict()
+        for key in self.__slots__:
+            setattr(self,key,self.project(key,data.get(key)))
+
+    def project(self,key,value):
+        """
+        Override to project a field that holds more sections.
+        """
+        return value
+
+    def __getitem__(self,key):
+        try:
+            return getattr(self,key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self,key,default=None):
+        val = getattr(self,key,None)
+        return default if val is None else val
+
+    def __contains__(self,key):
+        return getattr(self,key,None) is not None
+
+    def as_dict(self):
+        """
+        The fields as a dict, mainly for logging.
+        """
+        ret = dict()
+        for key in self.__slots__:
+            val = getattr(self,key)
+            if isinstance(val,projection):
+                val = val.as_dict()
+            elif isinstance(val,list):
+                val = [item.as_dict() if isinstance(item,projection) else item for item in val]
+            ret[key] = val
+        return ret
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__,self.as_dict())
+
+class runtimeState(projection):
+    __slots__ = ('connected','actualTemperature','actualHumidity','desiredHeat','desiredCool',
+                 'desiredHumidity','desiredDehumidity','desiredFanMode')
+
+class settingsState(projection):
+    __slots__ = ('hvacMode','useCelsius','fanControlRequired','fanMinOnTime','autoAway',
+                 'followMeComfort','backlightOnIntensity','backlightSleepIntensity')
+
+class climateState(projection):
+    __slots__ = ('climateRef','name','coolTemp','heatTemp','coolFan','heatFan')
+
+class programState(projection):
+    __slots__ = ('currentClimateRef','climates')
+
+    def project(self,key,value):
+        if key == 'climates':
+            return [climateState(climate) for climate in value] if value is not None else list()
+        return value
+
+class eventState(projection):
+    __slots__ = ('type','name','running','holdClimateRef','endDate','endTime')
+
+class capabilityState(projection):
+    __slots__ = ('id','type','value')
+
+class sensorState(projection):
+    __slots__ = ('id','name','type','code','inUse','capability')
+
+    def project(self,key,value):
+        if key == 'capability':
+            return [capabilityState(cb) for cb in value] if value is not None else list()
+        return value
+
+class forecastState(projection):
+    __slots__ = ('temperature','tempHigh','tempLow','relativeHumidity','pop','windSpeed',
+                 'windDirection','sky','weatherSymbol')
+
+class weatherState(projection):
+    __slots__ = ('forecasts',)
+
+    # The Weather nodes only look at the first 6 forecasts
+    max_forecasts = 6
+
+    def project(self,key,value):
+        if value is None:
+            return list()
+        return [forecastState(forecast) for forecast in value[:self.max_forecasts]]
+
+class thermostatState(projection):
+    """
+    One thermostat from the thermostatList.  Updates may only contain the
+    sections that changed, so update() only replaces the ones it's given.
+    """
+    __slots__ = ('identifier','thermostatTime','equipmentStatus','runtime','settings',
+                 'program','events','remoteSensors','weather')
+
+    sections = {
+        'runtime':  runtimeState,
+        'settings': settingsState,
+        'program':  programState,
+        'weather':  weatherState,
+    }
+
+    def project(self,key,value):
+        if value is None:
+            return None
+        if key in self.sections:
+            return self.sections[key](value)
+        if key == 'events':
+            return [eventState(event) for event in value]
+        if key == 'remoteSensors':
+            return [sensorState(sensor) for sensor in value]
+        return value
+
+    def update(self,tstat):
+        for key in self.__slots__:
+            if key in tstat:
+                setattr(self,key,self.project(key,tstat[key]))
@@ -0,0 +1,135 @@
+"""
+Keep the Ecobee tokens and refresh them before they expire.
+
+The tokens are handed out by get() as a read only snapshot, so they can't
+change while a request is using them.  A timer refreshes them lead seconds
+before they expire, so normally nothing has to wait on a refresh.  While a
+refresh is running get() waits for it to finish, and only one refresh runs at
+a time no matter how many threads ask for one.
+
+Getting new tokens and saving them is done by the refresh and save functions
+passed in, since that depends on Polyglot.
+"""
+
+import threading
+from types import MappingProxyType
+from datetime import datetime
+
+class tokenManager():
+
+    # Format of the expires time stored with the tokens
+    expires_fmt = '%Y-%m-%dT%H:%M:%S'
+
+    def __init__(self,logger,refresh,save,lead=1800,retry=60):
+        self.logger     = logger
+        # refresh(**kwargs) gets new tokens and passes them to set, returns True if it worked.
+        self.refresh_func = refresh
+        # save(tokenData) saves the tokens so they are there after a restart.
+        self.save_func  = save
+        # Seconds before they expire to refresh them
+        self.lead       = lead
+        # Seconds to wait before trying again when a refresh fails
+        self.retry      = retry
+        self.cond       = threading.Condition()
+        self.tokens     = MappingProxyType(dict())
+        self.refreshing = False
+        # The thread running the refresh, which must not wait on itself
+        self.refresher  = None
+        self.result     = False
+        self.timer      = None
+        self.stats      = { 'refreshes': 0, 'failed': 0, 'waits': 0 }
+
+    def get(self):
+        """
+        The current tokens, waits if they are being refreshed.
+        """
+        with self.cond:
+            if self.refreshing and self.refresher != threading.get_ident():
+                self.stats['waits'] += 1
+                while self.refreshing:
+                    self.cond.wait()
+            return self.tokens
+
+    def set(self,tokenData,save=False):
+        """
+        Use these tokens from now on, and save them if save is True.
+        """
+        tokens = MappingProxyType(dict(tokenData))
+        with self.cond:
+            self.tokens = tokens
+        if save:
+            self.save_func(dict(tokens))
+        exp = self.expires_in(tokens)
+        if exp is not None:
+            self._schedule(max(0,exp - self.lead),tokens)
+
+    def expires_in(self,tokens=None):
+        """
+        Seconds until the tokens expire, or None if we don't know.
+        """
+        if tokens is None:
+            tokens = self.tokens
+        if not 'expires' in tokens:
+            return None
+        try:
+            ts_exp = datetime.strptime(tokens['expires'],self.expires_fmt)
+        except ValueError as e:
+            self.logger.error("tokenManager: Unable to parse expires {}: {}".format(tokens['expires'],e))
+            return None
+        return (ts_exp - datetime.now()).total_seconds()
+
+    def refresh(self,stale=None,**kwargs):
+        """
+        Refresh the tokens, or wait for the refresh that is already running.
+        If stale is passed and the tokens are no longer the same, someone
+        already refreshed them so nothing is done.
+        Returns True if there are new tokens.
+        """
+        with self.cond:
+            if stale is not None and self.tokens.get('access_token') != stale.get('access_token'):
+                return True
+            if self.refreshing:
+                if self.refresher == threading.get_ident():
+                    return False
+                self.stats['waits'] += 1
+                while self.refreshing:
+                    self.cond.wait()
+                return self.result
+            self.refreshing = True
+            self.refresher  = threading.get_ident()
+            before = self.tokens
+        result = False
+        try:
+            result = self.refresh_func(**kwargs)
+        except Exception as e:
+            self.logger.error("tokenManager: refresh failed: {}".format(e),exc_info=True)
+        finally:
+            with self.cond:
+                self.refreshing = False
+                self.refresher  = None
+                self.result     = result
+                self.stats['refreshes'] += 1
+                if not result:
+                    self.stats['failed'] += 1
+                unchanged = self.tokens is before
+                self.cond.notify_all()
+        if not result and unchanged and 'refresh_token' in before:
+            self.logger.warning("tokenManager: refresh failed, will try again in {} seconds".format(self.retry))
+            self._schedule(self.retry,before)
+        return result
+
+    def _schedule(self,delay,tokens):
+        with self.cond:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.logger.debug("tokenManager: refresh in %s seconds",int(delay))
+            # Nothing to do when it fires if the tokens were changed by then.
+            self.timer = threading.Timer(delay,self.refresh,kwargs={ 'stale': tokens })
+            self.timer.daemon = True
+            self.timer.start()
+
+    def stop(self):
+        with self.cond:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
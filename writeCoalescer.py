@@ -0,0 +1,204 @@
+"""
+Queue of writes for one thermostat, run in order by its own worker thread.
+
+Commands only add their write here and return, so the Polyglot thread is never
+stuck waiting on Ecobee.
+
+An ISY program that sets the heat setpoint, cool setpoint and fan mode
+sends three commands right after each other.  Instead of a post for each,
+they are collected for a short window and sent as one request:
+
+  - setHold params are merged, the last one to set a param wins.  A
+    holdClimateRef replaces any temperatures before it, and temperatures
+    after a holdClimateRef replace it.
+  - resumeProgram drops any holds before it.
+  - thermostat.settings fields are merged, the last one wins.
+
+Each write passes a callback which is called with the result of the one
+post, so they all get acknowledged from it.  Anything added while a post is
+running goes in the next one, so writes are sent in the order they were added.
+"""
+
+import time,threading
+from collections import deque
+
+class writeCoalescer():
+
+    def __init__(self,thermostat,logger,window=.5,callback=None):
+        # thermostat must have ecobeePost(body) and holdDefaults()
+        self.thermostat = thermostat
+        self.logger     = logger
+        self.window     = window
+        # Called with this queue when depth or latency change.
+        self.callback   = callback
+        self.cond       = threading.Condition()
+        self.thread     = None
+        self.running    = True
+        # Number of writes waiting or being sent.
+        self.depth      = 0
+        # Seconds from adding each write until it was acknowledged.
+        self.latency    = deque(maxlen=100)
+        self.stats      = { 'writes': 0, 'posts': 0, 'failed': 0 }
+        self._reset()
+
+    def _reset(self):
+        self.resume    = False
+        self.hold      = None
+        self.settings  = dict()
+        self.callbacks = list()
+        # When the first of the pending writes was added
+        self.first     = None
+
+    def add_hold(self,params,callback=None):
+        with self.cond:
+            if not self.running:
+                return self._refuse(callback)
+            if self.hold is None:
+                self.hold = dict()
+            if 'holdClimateRef' in params:
+                self.hold.pop('heatHoldTemp',None)
+                self.hold.pop('coolHoldTemp',None)
+            elif 'heatHoldTemp' in params or 'coolHoldTemp' in params:
+                self.hold.pop('holdClimateRef',None)
+            self.hold.update(params)
+            self._add(callback)
+        self._changed()
+
+    def add_resume(self,callback=None):
+        with self.cond:
+            if not self.running:
+                return self._refuse(callback)
+            self.resume = True
+            self.hold   = None
+            self._add(callback)
+        self._changed()
+
+    def add_settings(self,settings,callback=None):
+        with self.cond:
+            if not self.running:
+                return self._refuse(callback)
+            self.settings.update(settings)
+            self._add(callback)
+        self._changed()
+
+    # Must be called with the lock held.  After stop() nothing will be sent,
+    # so the write fails right away and the caller can put back its values.
+    def _refuse(self,callback):
+        self.logger.error("writeCoalescer: {} is stopped, not sending write".format(self.thermostat.address))
+        self.stats['failed'] += 1
+        if callback is not None:
+            # Called in a thread so it doesn't run with our lock held.
+            threading.Thread(target=callback,args=(False,),daemon=True).start()
+        return False
+
+    # Must be called with the lock held.
+    def _add(self,callback):
+        if self.first is None:
+            self.first = time.time()
+        self.callbacks.append((callback,time.time()))
+        self.depth += 1
+        self.stats['writes'] += 1
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,name='writes_{}'.format(self.thermostat.address))
+            self.thread.daemon = True
+            self.thread.start()
+        self.cond.notify()
+
+    def body(self):
+        """
+        The post body for everything pending, must be called with the lock held.
+        """
+        body = dict()
+        functions = list()
+        if self.resume:
+            functions.append({ 'type': 'resumeProgram', 'params': { 'resumeAll': False } })
+        if self.hold is not None:
+            params = dict(self.hold)
+            if not 'holdClimateRef' in params:
+                # Ecobee needs both temperatures, use the current ones for what wasn't set.
+                for key, val in self.thermostat.holdDefaults().items():
+                    if not key in params:
+                        params[key] = val
+            functions.append({ 'type': 'setHold', 'params': params })
+        if len(functions) > 0:
+            body['functions'] = functions
+        if len(self.settings) > 0:
+            body['thermostat'] = { 'settings': dict(self.settings) }
+        return body
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and self.first is None:
+                    self.cond.wait()
+                if self.first is None:
+                    return
+                # Give the rest of a burst of commands time to arrive, unless we are stopping.
+                wait = self.first + self.window - time.time()
+                while self.running and wait > 0:
+                    self.cond.wait(wait)
+                    wait = self.first + self.window - time.time()
+                body = self.body()
+                callbacks = self.callbacks
+                self._reset()
+            self._post(body,callbacks)
+
+    def _post(self,body,callbacks):
+        self.logger.debug("writeCoalescer: posting %d writes as %s",len(callbacks),body)
+        try:
+            res = self.thermostat.ecobeePost(body)
+        except Exception as e:
+            self.logger.error("writeCoalescer: post failed: {}".format(e),exc_info=True)
+            res = False
+        self.stats['posts'] += 1
+        if not res:
+            self.stats['failed'] += 1
+        for callback, added in callbacks:
+            try:
+                if callback is not None:
+                    callback(res)
+            except Exception as e:
+                self.logger.error("writeCoalescer: callback failed: {}".format(e),exc_info=True)
+            with self.cond:
+                self.depth -= 1
+                self.latency.append(time.time() - added)
+        self._changed()
+
+    def average_latency(self):
+        """
+        Average seconds the recent writes took to be acknowledged, or None
+        if there haven't been any.
+        """
+        with self.cond:
+            return sum(self.latency) / len(self.latency) if len(self.latency) > 0 else None
+
+    def stop(self,timeout=None):
+        """
+        Send anything pending now and stop the worker.
+        """
+        self.signal()
+        self.join(timeout)
+
+    def signal(self):
+        """
+        Tell the worker to send anything pending now and stop, without waiting.
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def join(self,timeout=None):
+        """
+        Wait for the worker to stop after signal().
+        """
+        with self.cond:
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _changed(self):
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception as e:
+                self.logger.error("writeCoalescer: callback failed: {}".format(e),exc_info=True)